@@ -1,12 +1,21 @@
+import cProfile
 import gzip
 import json
+import pstats
 import random
 import socket
+import struct
 import traceback
+import zlib
+from array import array
+from collections import defaultdict, deque
 from configparser import ConfigParser
 from datetime import datetime, timezone
+from functools import lru_cache
+from queue import Empty, Queue
 from sys import argv, exc_info
-from time import time, sleep
+from threading import Thread
+from time import perf_counter, time, sleep
 
 try:
     config = ConfigParser()
@@ -52,6 +61,69 @@ try:
     BUTTON_MAP_ADDRESS = int(
         config.get('Settings', 'BUTTON_MAP_ADDRESS'), 0x10)
 
+    if config.has_option('Settings', 'MAX_READ_GAP'):
+        MAX_READ_GAP = int(config.get('Settings', 'MAX_READ_GAP'))
+    else:
+        MAX_READ_GAP = 64
+    if config.has_option('Settings', 'MAX_READ_LENGTH'):
+        MAX_READ_LENGTH = int(config.get('Settings', 'MAX_READ_LENGTH'))
+    else:
+        MAX_READ_LENGTH = 1280
+    if config.has_option('Settings', 'MAX_WRITE_LENGTH'):
+        MAX_WRITE_LENGTH = int(config.get('Settings', 'MAX_WRITE_LENGTH'))
+    else:
+        MAX_WRITE_LENGTH = 256
+    if config.has_option('Settings', 'MAX_WRITE_GAP'):
+        MAX_WRITE_GAP = int(config.get('Settings', 'MAX_WRITE_GAP'))
+    else:
+        MAX_WRITE_GAP = 8
+
+    if config.has_option('Settings', 'FIELD_POLL_INTERVAL'):
+        FIELD_POLL_INTERVAL = float(
+            config.get('Settings', 'FIELD_POLL_INTERVAL'))
+    else:
+        FIELD_POLL_INTERVAL = 0
+    if config.has_option('Settings', 'BATTLE_POLL_INTERVAL'):
+        BATTLE_POLL_INTERVAL = float(
+            config.get('Settings', 'BATTLE_POLL_INTERVAL'))
+    else:
+        BATTLE_POLL_INTERVAL = 0
+    if config.has_option('Settings', 'CHEST_POLL_INTERVAL'):
+        CHEST_POLL_INTERVAL = float(
+            config.get('Settings', 'CHEST_POLL_INTERVAL'))
+    else:
+        CHEST_POLL_INTERVAL = 0
+
+    if config.has_option('Settings', 'PUSH_UPDATES'):
+        PUSH_UPDATES = config.get('Settings', 'PUSH_UPDATES').lower() == 'yes'
+    else:
+        PUSH_UPDATES = False
+    if config.has_option('Settings', 'KEEPALIVE_INTERVAL'):
+        KEEPALIVE_INTERVAL = float(
+            config.get('Settings', 'KEEPALIVE_INTERVAL'))
+    else:
+        KEEPALIVE_INTERVAL = 15
+
+    if config.has_option('Settings', 'BINARY_PROTOCOL'):
+        BINARY_PROTOCOL = (
+            config.get('Settings', 'BINARY_PROTOCOL').lower() == 'yes')
+    else:
+        BINARY_PROTOCOL = False
+
+    if config.has_option('Settings', 'PROFILE_INTERVAL'):
+        PROFILE_INTERVAL = float(config.get('Settings', 'PROFILE_INTERVAL'))
+    else:
+        PROFILE_INTERVAL = 0
+    if config.has_option('Settings', 'PROFILE_WINDOW'):
+        PROFILE_WINDOW = int(config.get('Settings', 'PROFILE_WINDOW'))
+    else:
+        PROFILE_WINDOW = 300
+    if config.has_option('Settings', 'PROFILE_CPROFILE'):
+        PROFILE_CPROFILE = (
+            config.get('Settings', 'PROFILE_CPROFILE').lower() == 'yes')
+    else:
+        PROFILE_CPROFILE = False
+
     if config.has_option('Settings', 'TEST_LATENCY'):
         TEST_LATENCY = config.get('Settings', 'TEST_LATENCY').lower() == 'yes'
     else:
@@ -66,6 +138,52 @@ retroarch_socket.settimeout(POLL_INTERVAL / 5.0)
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 server_socket.settimeout(POLL_INTERVAL)
 
+RAM_REGIONS = {
+    'played_time': (PLAYED_TIME_ADDRESS, 4),
+    'field_items': (FIELD_ITEM_ADDRESS, 512),
+    'battle_items': (BATTLE_ITEM_ADDRESS, 1280),
+    'battle_characters': (BATTLE_CHAR_ADDRESS, 8),
+    'status_1': (STATUS_1_ADDRESS, 8),
+    'status_2': (STATUS_2_ADDRESS, 8),
+    'chests': (CHEST_ADDRESS, 0x40),
+    'gp': (GP_ADDRESS, 3),
+    }
+PROBE_REGIONS = ('played_time', 'battle_characters')
+BATTLE_REGIONS = ('field_items', 'battle_items', 'status_1', 'status_2')
+POLL_INTERVALS = {
+    'field_items': FIELD_POLL_INTERVAL,
+    'battle_items': BATTLE_POLL_INTERVAL,
+    'status_1': BATTLE_POLL_INTERVAL,
+    'status_2': BATTLE_POLL_INTERVAL,
+    'chests': CHEST_POLL_INTERVAL,
+    'gp': CHEST_POLL_INTERVAL,
+    }
+read_plans = {}
+PROFILE_FILENAME = 'beyond_parity_profile.txt'
+PACKET_MAGIC = 0xB1
+PACKET_HEADER = struct.Struct('>BBII')
+PACKET_DIRECTIVES = ('Success', 'ERROR', 'REPORT', 'LOG', 'SYNC', 'SUBSCRIBE',
+                     'SUBSCRIBED', 'DELTA', 'CHESTS', 'STATUS_ON',
+                     'STATUS_OFF', 'ACK', 'BATCH', 'FRAGMENT', 'STATUS',
+                     'CHEST_DELTA')
+BATCH_ENTRY = struct.Struct('>H')
+FRAGMENT_ENTRY = struct.Struct('>HH')
+MAX_DATAGRAM_SIZE = 4096
+FRAGMENT_SIZE = 4000
+MAX_FRAGMENTS = 64
+FRAGMENT_TIMEOUT = 5
+INVENTORY_ENTRY = struct.Struct('>Bh')
+LOG_ENTRY = struct.Struct('>IBh')
+STATUS_ENTRY = struct.Struct('>BBI')
+STATUS_MASKS = struct.Struct('>BII')
+CHEST_ENTRY = struct.Struct('>BB')
+BINARY_OFFER = 'B1'
+SUBSCRIBE_RETRY = 10
+PUSH_WINDOW = 256
+
+poll_scheduler = None
+tick_profiler = None
+retroarch_traffic = defaultdict(int)
 previous_inventory = None
 previous_played_time = 999999999
 previous_status = None
@@ -73,6 +191,25 @@ previous_chests = None
 previous_gp = None
 
 previous_sync_request = 0
+force_sync = False
+ledger_epoch = 0
+ledger_version = 0
+session_ledger = None
+chest_version = 0
+session_chests = bytearray(0x40)
+unconfirmed_chests = bytearray(0x40)
+subscribed_until = 0
+unanswered_subscriptions = 0
+applied_pushes = []
+versioned_server = None
+unanswered_forced_syncs = 0
+binary_protocol = False
+outgoing_packets = []
+fragments = {}
+fragment_sequence = 0
+server_responses = Queue()
+unapplied_directives = []
+previous_poll_time = 0
 change_queue = []
 message_index = 0
 previous_log = None
@@ -122,60 +259,435 @@ def convert_dict_keys_to_int(mydict):
 
 
 def server_send(msg):
+    if not isinstance(msg, str):
+        # binary packets go out together in send_server_packets
+        outgoing_packets.append(msg)
+        return
     msg = msg.encode()
     temp = b'!' + gzip.compress(msg)
     if len(temp) < len(msg):
         msg = temp
-    assert len(msg) < 4096
+    assert len(msg) < MAX_DATAGRAM_SIZE
     if TEST_LATENCY:
         sleep(random.random() * 6)
     server_socket.send(msg)
 
 
+def send_server_packets():
+    global outgoing_packets
+    packets, outgoing_packets = outgoing_packets, []
+    for msg in encode_batches(packets):
+        if len(msg) < MAX_DATAGRAM_SIZE:
+            fragments = [msg]
+        else:
+            fragments = encode_fragments(msg)
+        for msg in fragments:
+            if TEST_LATENCY:
+                sleep(random.random() * 6)
+            server_socket.send(msg)
+
+
 def server_receive():
-    msg = server_socket.recv(4096)
+    msg = server_socket.recv(MAX_DATAGRAM_SIZE)
     server_socket.settimeout(POLL_INTERVAL)
-    if msg[0] == ord('!'):
-        msg = gzip.decompress(msg[1:])
-    msg = msg.decode('ascii').strip()
+    if msg[0] == PACKET_MAGIC:
+        if msg[1] == PACKET_DIRECTIVES.index('FRAGMENT') + 1:
+            msg = reassemble(msg)
+        if msg is None:
+            msg = []
+        else:
+            msg = [decode_packet(packet) for packet in split_batch(msg)]
+    else:
+        if msg[0] == ord('!'):
+            msg = gzip.decompress(msg[1:])
+        msg = msg.decode('ascii').strip()
     if TEST_LATENCY:
         sleep(random.random() * 6)
     return msg
 
 
-def write_retroarch_data(address, data):
-    MAX_WRITE_LENGTH = 4
-    while data:
-        s = ' '.join(['{0:0>2X}'.format(d) for d in data[:MAX_WRITE_LENGTH]])
-        cmd = 'WRITE_CORE_RAM {0:0>6x} {1}'.format(address, s)
-        retroarch_socket.send(cmd.encode())
-        data = data[MAX_WRITE_LENGTH:]
-        address += MAX_WRITE_LENGTH
+def encode_packet(directive, payload=b'', sequence=0):
+    opcode = PACKET_DIRECTIVES.index(directive) + 1
+    return PACKET_HEADER.pack(PACKET_MAGIC, opcode, SERIES_NUMBER,
+                              sequence) + payload
+
+
+def encode_batches(packets):
+    envelopes = [[]]
+    size = PACKET_HEADER.size
+    for data in packets:
+        if (envelopes[-1] and size + BATCH_ENTRY.size + len(data)
+                >= MAX_DATAGRAM_SIZE):
+            envelopes.append([])
+            size = PACKET_HEADER.size
+        envelopes[-1].append(data)
+        size += BATCH_ENTRY.size + len(data)
+
+    for envelope in envelopes:
+        if len(envelope) == 1:
+            yield envelope[0]
+        elif envelope:
+            yield encode_packet('BATCH', b''.join(
+                BATCH_ENTRY.pack(len(data)) + data for data in envelope))
+
+
+def encode_fragments(data):
+    global fragment_sequence
+    fragment_sequence = (fragment_sequence + 1) & 0xFFFFFFFF
+    count = (len(data) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+    assert count <= MAX_FRAGMENTS
+    return [encode_packet('FRAGMENT', FRAGMENT_ENTRY.pack(index, count)
+                          + data[index*FRAGMENT_SIZE:(index+1)*FRAGMENT_SIZE],
+                          fragment_sequence)
+            for index in range(count)]
+
+
+def reassemble(data):
+    # returns the whole packet once all of its fragments have arrived;
+    # fragments of packets that never complete are dropped after a while
+    now = time()
+    for key in [key for key in fragments
+                if now - fragments[key][0] > FRAGMENT_TIMEOUT]:
+        del(fragments[key])
+
+    _, _, _, sequence = PACKET_HEADER.unpack_from(data)
+    index, count = FRAGMENT_ENTRY.unpack_from(data, PACKET_HEADER.size)
+    if sequence not in fragments:
+        fragments[sequence] = [now, {}]
+    pieces = fragments[sequence][1]
+    pieces[index] = data[PACKET_HEADER.size+FRAGMENT_ENTRY.size:]
+    if len(pieces) < count:
+        return None
+    del(fragments[sequence])
+    return b''.join(pieces[i] for i in range(count))
+
+
+def split_batch(data):
+    if data[1] != PACKET_DIRECTIVES.index('BATCH') + 1:
+        return [data]
+    packets = []
+    offset = PACKET_HEADER.size
+    while offset < len(data):
+        length, = BATCH_ENTRY.unpack_from(data, offset)
+        offset += BATCH_ENTRY.size
+        packets.append(data[offset:offset+length])
+        offset += length
+    return packets
+
+
+def decode_packet(data):
+    # returns (directive, parameters, push sequence) like the text protocol
+    _, opcode, _, sequence = PACKET_HEADER.unpack_from(data)
+    directive = PACKET_DIRECTIVES[opcode - 1]
+    payload = data[PACKET_HEADER.size:]
+    parameters = None
+    if directive == 'ERROR':
+        parameters = payload.decode()
+    elif directive == 'REPORT':
+        parameters = {}
+    elif directive == 'LOG':
+        parameters = list(struct.unpack(
+            '>{0}I'.format(len(payload) // 4), payload))
+    elif directive == 'SUBSCRIBED':
+        parameters = list(struct.unpack('>HI', payload))
+    elif directive == 'DELTA':
+        parameters = list(struct.unpack_from('>III', payload))
+        parameters.append(dict(INVENTORY_ENTRY.iter_unpack(payload[12:])))
+    elif directive == 'CHESTS':
+        parameters = list(payload)
+    elif directive == 'CHEST_DELTA':
+        parameters = list(struct.unpack_from('>II', payload))
+        parameters.append(dict(CHEST_ENTRY.iter_unpack(payload[8:])))
+    elif directive in ('STATUS_ON', 'STATUS_OFF'):
+        character, mask = struct.unpack('>BI', payload)
+        parameters = [character, '{0:X}'.format(mask)]
+    elif directive == 'STATUS':
+        parameters = [list(masks) for masks in
+                      STATUS_MASKS.iter_unpack(payload)]
+    return directive, parameters, sequence or None
+
+
+def pack_inventory(inventory):
+    return b''.join(INVENTORY_ENTRY.pack(item, amount)
+                    for (item, amount) in inventory.items())
+
+
+def pack_change_queue(queue):
+    items = [LOG_ENTRY.pack(*change) for change in queue
+             if isinstance(change[0], int)]
+    statuses = [STATUS_ENTRY.pack(index == 'STATUS_ON', item,
+                                  int(change, 0x10))
+                for (index, item, change) in queue
+                if not isinstance(index, int)]
+    return struct.pack('>H', len(items)) + b''.join(items + statuses)
+
+
+def retroarch_send(cmd):
+    retroarch_socket.send(cmd)
+    retroarch_traffic['commands'] += 1
+    retroarch_traffic['sent'] += len(cmd)
+
+
+def get_changed_spans(previous, data):
+    spans = []
+    if previous == data:
+        return spans
+
+    for (i, (a, b)) in enumerate(zip(previous, data)):
+        if a == b:
+            continue
+        if spans and i - spans[-1][1] <= MAX_WRITE_GAP:
+            spans[-1][1] = i + 1
+        else:
+            spans.append([i, i + 1])
+    return spans
+
+
+def plan_writes(address, data, previous=None):
+    # returns the spans that differ and the commands that write them
+    data = bytes(data)
+    if previous is None:
+        spans = [(0, len(data))]
+    else:
+        assert len(previous) == len(data)
+        spans = get_changed_spans(previous, data)
+
+    commands = []
+    for (start, end) in spans:
+        for i in range(start, end, MAX_WRITE_LENGTH):
+            chunk = data[i:min(i + MAX_WRITE_LENGTH, end)]
+            cmd = 'WRITE_CORE_RAM {0:0>6x} {1}'.format(
+                address + i, chunk.hex(' ').upper())
+            commands.append(cmd.encode())
+    return spans, commands
+
+
+def write_retroarch_data(address, data, previous=None):
+    spans, commands = plan_writes(address, data, previous)
+    for cmd in commands:
+        retroarch_send(cmd)
+    return sum(end - start for (start, end) in spans), len(commands)
+
+
+def get_fingerprint(data, spans, offset=0):
+    return zlib.crc32(b''.join(bytes(data[start-offset:end-offset])
+                               for (start, end) in spans))
 
 
 def get_retroarch_data(address, num_bytes):
+    request_retroarch_data(address, num_bytes)
+    return receive_retroarch_data(num_bytes)
+
+
+def request_retroarch_data(address, num_bytes):
     cmd = 'READ_CORE_RAM {0:0>6x} {1}'.format(address, num_bytes)
-    retroarch_socket.send(cmd.encode())
+    retroarch_send(cmd.encode())
+
+
+def receive_retroarch_data(num_bytes):
     expected_length = 21 + (3 * num_bytes)
     try:
-        data = retroarch_socket.recv(expected_length).decode('ascii').strip()
+        data = retroarch_socket.recv(expected_length)
     except socket.timeout:
         raise IOError('RetroArch not responding.')
-    data = [int(d, 0x10) for d in data.split(' ')[2:]]
+    retroarch_traffic['received'] += len(data)
+    data = data.split(b' ', 2)[2:]
+    try:
+        data = bytes.fromhex(data[0].decode('ascii')) if data else b''
+    except ValueError:
+        data = b''
     if len(data) != num_bytes:
         raise IOError('RetroArch RAM data read error: {0}/{1} bytes'.format(
             len(data), num_bytes))
     return data
 
 
+def plan_reads(names):
+    regions = sorted((RAM_REGIONS[name] + (name,)) for name in names)
+    plan = []
+    for (address, length, name) in regions:
+        if plan:
+            start, end, views = plan[-1]
+            new_end = max(end, address + length)
+            if (address - end <= MAX_READ_GAP
+                    and new_end - start <= MAX_READ_LENGTH):
+                plan[-1] = (start, new_end, views)
+                views.append((name, address - start, length))
+                continue
+        plan.append((address, address + length, [(name, 0, length)]))
+
+    return [(start, end - start, views) for (start, end, views) in plan]
+
+
+class RamSnapshot:
+    def __init__(self, regions):
+        self.regions = regions
+
+    def __getitem__(self, name):
+        return self.regions[name]
+
+    def __contains__(self, name):
+        return name in self.regions
+
+    @property
+    def field_items(self):
+        return get_field_items(self.regions['field_items'])
+
+    @property
+    def battle_items(self):
+        return get_battle_items(self.regions['battle_items'])
+
+    @property
+    def statuses(self):
+        return get_status_data(self.regions['status_1'],
+                               self.regions['status_2'])
+
+    @property
+    def chests(self):
+        return self.regions['chests']
+
+    def write(self, name, data):
+        address, length = RAM_REGIONS[name]
+        data = bytes(data)
+        assert len(data) == length
+        result = write_retroarch_data(address, data,
+                                      previous=self.regions.get(name))
+        self.regions[name] = memoryview(data)
+        return result
+
+
+def read_regions(names):
+    names = tuple(names)
+    if names not in read_plans:
+        read_plans[names] = plan_reads(names)
+
+    regions = {}
+    for (address, num_bytes, views) in read_plans[names]:
+        data = memoryview(get_retroarch_data(address, num_bytes))
+        for (name, offset, length) in views:
+            regions[name] = data[offset:offset+length]
+    return RamSnapshot(regions)
+
+
+class PollScheduler:
+    def __init__(self):
+        self.regions = {}
+        self.read_at = {}
+        self.previous_poll = {}
+        self.in_battle = False
+        self.fresh = set()
+
+    def poll(self, force=()):
+        # The probe is read every tick. A region read at the current played
+        # time is still what is in RAM, since the game has not run since,
+        # so it is reused unless the caller forces a read.
+        now = time()
+        probe = read_regions(PROBE_REGIONS)
+        played_time = bytes(probe['played_time'])
+
+        due = set()
+        if (self.in_battle or probe['battle_characters']
+                != self.regions.get('battle_characters')):
+            due |= set(BATTLE_REGIONS)
+        for (name, interval) in POLL_INTERVALS.items():
+            if now - self.previous_poll.get(name, 0) >= interval:
+                due.add(name)
+        current = {name for name in self.regions
+                   if self.read_at.get(name) == played_time}
+        due = (due - current) | set(force)
+
+        self.regions.update(probe.regions)
+        if due:
+            ram = read_regions(sorted(due))
+            for name in due:
+                self.previous_poll[name] = now
+            self.regions.update(ram.regions)
+        for name in set(PROBE_REGIONS) | due:
+            self.read_at[name] = played_time
+
+        self.fresh = set(PROBE_REGIONS) | due | current
+        return RamSnapshot(self.regions)
+
+
+def get_percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class TickProfiler:
+    # Each main_loop tick is split into phases by calling mark() at the
+    # end of each one; time since the previous mark goes to that phase.
+    def __init__(self, window):
+        self.phases = defaultdict(lambda: deque(maxlen=window))
+        self.traffic = defaultdict(lambda: deque(maxlen=window))
+        self.pauses = deque(maxlen=window)
+        self.tick_phases = defaultdict(float)
+        self.tick_traffic = {}
+        self.previous_mark = perf_counter()
+        self.previous_report = time()
+        self.profile = cProfile.Profile() if PROFILE_CPROFILE else None
+
+    def start_tick(self):
+        self.tick_phases.clear()
+        self.tick_traffic = dict(retroarch_traffic)
+        if self.profile is not None:
+            self.profile.enable()
+        self.previous_mark = perf_counter()
+
+    def mark(self, phase):
+        now = perf_counter()
+        self.tick_phases[phase] += now - self.previous_mark
+        self.previous_mark = now
+
+    def end_tick(self):
+        self.mark('other')
+        if self.profile is not None:
+            self.profile.disable()
+        self.tick_phases['total'] = sum(self.tick_phases.values())
+        for (phase, elapsed) in self.tick_phases.items():
+            self.phases[phase].append(elapsed)
+        for name in ('commands', 'sent', 'received'):
+            self.traffic[name].append(
+                retroarch_traffic[name] - self.tick_traffic.get(name, 0))
+
+        if PROFILE_INTERVAL and time() - self.previous_report >= (
+                PROFILE_INTERVAL):
+            self.report()
+            self.previous_report = time()
+
+    def report(self):
+        log('Tick profile, last {0} ticks (p50/p90/p99 ms):'.format(
+            len(self.phases['total'])))
+        for (phase, samples) in sorted(self.phases.items()):
+            log('  {0}: {1:.1f}/{2:.1f}/{3:.1f} ({4} ticks)'.format(
+                phase, *[get_percentile(samples, f) * 1000
+                         for f in (0.5, 0.9, 0.99)], len(samples)))
+        log('RetroArch per tick (p50/p90/p99): {0}'.format(', '.join(
+            '{0} {1}/{2}/{3}'.format(name, *[get_percentile(samples, f)
+                                             for f in (0.5, 0.9, 0.99)])
+            for (name, samples) in sorted(self.traffic.items()))))
+        if self.pauses:
+            log('Write pauses (p50/p90/max ms): {0:.1f}/{1:.1f}/{2:.1f} '
+                'over {3} writes'.format(
+                    *[get_percentile(self.pauses, f) * 1000
+                      for f in (0.5, 0.9, 1)], len(self.pauses)))
+
+        if self.profile is not None:
+            f = open(PROFILE_FILENAME, 'w')
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(30)
+            f.close()
+            log('Wrote cProfile summary to {0}.'.format(PROFILE_FILENAME))
+
+
 def fix_button_mapping():
-    DEFAULT_BUTTON_MAP = [0x12, 0x34, 0x56, 0x06]
+    DEFAULT_BUTTON_MAP = bytes([0x12, 0x34, 0x56, 0x06])
     write_retroarch_data(BUTTON_MAP_ADDRESS, DEFAULT_BUTTON_MAP)
 
 
 def test_write_retroarch():
-    DEFAULT_BUTTON_MAP = [0x12, 0x34, 0x56, 0x06]
-    REVISED_BUTTON_MAP = [0x12, 0x34, 0x56, 0xF6]
+    DEFAULT_BUTTON_MAP = bytes([0x12, 0x34, 0x56, 0x06])
+    REVISED_BUTTON_MAP = bytes([0x12, 0x34, 0x56, 0xF6])
     data = get_retroarch_data(BUTTON_MAP_ADDRESS, 4)
     if data == DEFAULT_BUTTON_MAP and data != REVISED_BUTTON_MAP:
         log('RetroArch read SUCCESS')
@@ -193,24 +705,88 @@ def test_write_retroarch():
         log('RetroArch read FAILURE')
 
 
-def items_to_dict(items):
-    order, inventory = [], {}
+class Inventory:
+    # order maps slot -> item (0xFF is an empty slot), counts maps
+    # item -> amount, and slots maps item -> slot (-1 if not held).
+    def __init__(self, order, counts):
+        self.order = bytes(order)
+        self.counts = bytes(counts)
+        assert len(self.order) == len(self.counts) == 0x100
+        assert self.counts[0xFF] == 0
+        self.slots = array('h', [-1]) * 0x100
+        for (slot, item) in enumerate(self.order):
+            if item != 0xFF:
+                assert self.slots[item] < 0
+                self.slots[item] = slot
+
+    @classmethod
+    def from_items(cls, items, amounts):
+        order = bytearray(items)
+        counts = bytearray(0x100)
+        seen = bytearray(0x100)
+        for (slot, (item, amount)) in enumerate(zip(items, amounts)):
+            if item == 0xFF:
+                continue
+            if seen[item]:
+                order[slot] = 0xFF
+            seen[item] = 1
+            counts[item] = max(counts[item], amount)
+        return cls(order, counts)
 
-    for i in range(0x100):
-        inventory[i] = 0
+    def __eq__(self, other):
+        return isinstance(other, Inventory) and self.counts == other.counts
 
-    for i, a in items:
-        if i in order:
-            order.append(0xff)
-        else:
-            order.append(i)
+    def __ne__(self, other):
+        return not self == other
 
-        if i == 0xff:
-            inventory[i] = 0
-        else:
-            inventory[i] = max(inventory[i], a)
+    def __contains__(self, item):
+        return self.slots[item] >= 0
+
+    def __getitem__(self, item):
+        return self.counts[item]
+
+    @property
+    def slot_amounts(self):
+        return self.order.translate(self.counts)
 
-    return order, inventory
+    @property
+    def field_data(self):
+        return self.order + self.slot_amounts
+
+    def as_dict(self):
+        return {item: amount for (item, amount) in enumerate(self.counts)
+                if amount > 0}
+
+    def count_items(self):
+        return sum(1 for amount in self.counts[:0xFF] if 1 <= amount <= 99)
+
+    def diff(self, other):
+        if self.counts == other.counts:
+            return []
+        return [(item, a - b) for (item, (a, b))
+                in enumerate(zip(self.counts, other.counts)) if a != b]
+
+    def merge(self, amounts):
+        # Items that run out give up their slot and new items take the
+        # lowest free slots, leaving every other item where it was.
+        counts = bytearray(min(max(amount, 0), 99) for amount in amounts)
+        counts[0xFF] = 0
+        order = bytearray(self.order)
+        for (item, slot) in enumerate(self.slots):
+            if slot >= 0 and counts[item] == 0:
+                order[slot] = 0xFF
+
+        free = 0
+        for item in range(0xFF):
+            if counts[item] > 0 and self.slots[item] < 0:
+                free = order.index(0xFF, free)
+                order[free] = item
+        return Inventory(order, counts)
+
+
+@lru_cache(maxsize=4)
+def parse_inventory(items, amounts):
+    return Inventory.from_items(items, amounts)
 
 
 def get_field_items_raw():
@@ -221,146 +797,124 @@ def get_field_items_raw():
 def get_field_items(data):
     items, amounts = data[:256], data[256:]
     assert len(items) == len(amounts) == 256
-    return list(zip(items, amounts))
-
-
-def get_battle_items_raw():
-    data = get_retroarch_data(BATTLE_ITEM_ADDRESS, 1280)
-    return data
+    return items, amounts
 
 
 def get_battle_items(data):
     items, amounts = data[::5], data[3::5]
     assert len(items) == len(amounts) == 256
-    return list(zip(items, amounts))
+    return items, amounts
 
 
 def calculate_similarity(aa, bb):
     # assumption: no duplicates in either list, except 0xFF
-    numer, denom = 0, 0
-    for ((a_item, a_amount), (b_item, b_amount)) in zip(aa, bb):
+    (a_items, a_amounts), (b_items, b_amounts) = aa, bb
+    assert len(a_items) == len(b_items) == 256
+    if a_items == b_items and a_amounts == b_amounts:
+        return 1.0
+
+    numer = 0
+    for (a_item, b_item, a_amount, b_amount) in zip(
+            a_items, b_items, a_amounts, b_amounts):
         if a_item == b_item:
             numer += 1
             if a_amount == b_amount:
                 numer += 1
-        denom += 2
-    assert denom == 512
-    return numer / float(denom)
-
-
-def sync_field_battle(battle_order, battle_inventory):
-    values = list(battle_order)
-    for v in list(values):
-        if v == 0xff:
-            values.append(0)
-            continue
-        values.append(battle_inventory[v])
+    return numer / 512.0
 
-    write_retroarch_data(FIELD_ITEM_ADDRESS, values)
 
+def sync_field_battle(battle_inventory, ram):
+    ram.write('field_items', battle_inventory.field_data)
 
-def write_inventory(order, to_inventory, raw_data, in_battle):
-    inventory = dict(to_inventory)
-    for item in range(0x100):
-        if item not in inventory:
-            inventory[item] = 0
-            continue
-        inventory[item] = min(max(inventory[item], 0), 99)
-    inventory[0xFF] = 0
-
-    for item in sorted(inventory):
-        if item < 0xFF:
-            if item in order and (
-                    item not in inventory or inventory[item] == 0):
-                assert order.count(item) == 1
-                index = order.index(item)
-                order[index] = 0xFF
-
-    for item in sorted(inventory):
-        if item < 0xFF:
-            if inventory[item] > 0 and item not in order:
-                index = order.index(0xFF)
-                order[index] = item
-
-    assert len(order) == 256
-    unique = [item for item in order if item != 0xFF]
-    assert len(unique) == len(set(unique))
 
-    if in_battle:
-        battle_data = get_retroarch_data(BATTLE_ITEM_ADDRESS, 1280)
-        battle_data[::5] = order
-        amounts = []
-        for item in order:
-            amounts.append(inventory[item] if item < 0xFF else 0)
-        battle_data[3::5] = amounts
-
-    field_data = order + [inventory[item] for item in order]
-
-    # Here we perform multiple hacky checks to guarantee that memory has not
-    # changed before we write to it, without interrupting the player
-    # experience *too* much.
-    if in_battle:
-        new_raw = get_battle_items_raw()
-    else:
-        new_raw = get_field_items_raw()
-
-    if new_raw != raw_data:
-        log('Did not write inventory because of race condition (1).',
+def write_inventory(inventory, ram, in_battle):
+    if not SYNC_INVENTORY:
+        log('Did not write inventory because of configuration.',
             is_debug=True)
         return False
 
-    pause_retroarch()
+    # Everything is planned before the game is paused. While it is paused,
+    # only the bytes about to be overwritten are read back, all at once,
+    # and compared against the last poll. Then all of the writes go out
+    # back to back.
+    writes = []
+    if in_battle:
+        battle_data = bytearray(ram['battle_items'])
+        battle_data[::5] = inventory.order
+        battle_data[3::5] = inventory.slot_amounts
+        writes.append(('battle_items', battle_data))
+    writes.append(('field_items', inventory.field_data))
+
+    plans = []
+    for (name, data) in writes:
+        address, _ = RAM_REGIONS[name]
+        spans, commands = plan_writes(address, data, previous=ram[name])
+        fingerprint = get_fingerprint(ram[name], spans)
+        plans.append((name, data, address, spans, commands, fingerprint))
 
+    pause_retroarch()
+    started = perf_counter()
     try:
         sleep(PAUSE_DELAY_INTERVAL)
-        if in_battle:
-            new_raw = get_battle_items_raw()
-        else:
-            new_raw = get_field_items_raw()
-
-        assert new_raw == raw_data
-
-        success = False
-        if SYNC_INVENTORY:
-            if in_battle:
-                write_retroarch_data(BATTLE_ITEM_ADDRESS, battle_data)
-                log('Wrote battle inventory.', is_debug=True)
-            write_retroarch_data(FIELD_ITEM_ADDRESS, field_data)
-            log('Wrote field inventory.', is_debug=True)
-            success = True
-            if DEBUG:
-                verify_raw = get_field_items_raw()
-                verify_items = get_field_items(verify_raw)
-                _, verify_inventory = items_to_dict(verify_items)
-                if verify_inventory == inventory:
-                    log('The write was successful.', is_debug=True)
-                    success = True
-                else:
-                    log('ALERT: The write has failed!', is_debug=True)
-                    error_dict = {
-                        k: (inventory[k], verify_inventory[k])
-                        for k in range(0x100)
-                        if k in inventory and k in verify_inventory
-                        and inventory[k] != verify_inventory[k]
-                        }
-                    log(error_dict)
-                    success = False
-        else:
-            log('Did not write inventory because of configuration.',
-                is_debug=True)
-            success = False
-
-        toggle_pause_retroarch()
-        return success
+        checks = [(address, spans, fingerprint)
+                  for (_, _, address, spans, _, fingerprint) in plans
+                  if spans]
+        for (address, spans, _) in checks:
+            start, end = spans[0][0], spans[-1][1]
+            request_retroarch_data(address + start, end - start)
+        replies = [receive_retroarch_data(spans[-1][1] - spans[0][0])
+                   for (_, spans, _) in checks]
+        for ((_, spans, fingerprint), data) in zip(checks, replies):
+            if get_fingerprint(data, spans, offset=spans[0][0]) != (
+                    fingerprint):
+                raise IOError('Inventory changed before the write.')
+        for (_, _, _, _, commands, _) in plans:
+            for cmd in commands:
+                retroarch_send(cmd)
     except:
-        log('Did not write inventory because of race condition (2).',
-            is_debug=True)
         toggle_pause_retroarch()
+        log('Did not write inventory because of race condition.',
+            is_debug=True)
         return False
+    toggle_pause_retroarch()
+    paused = perf_counter() - started
+    if tick_profiler is not None:
+        tick_profiler.pauses.append(paused)
+
+    for (name, data, _, spans, commands, _) in plans:
+        ram.regions[name] = memoryview(bytes(data))
+        log('Wrote {0} ({1} bytes, {2} commands).'.format(
+            name.replace('_', ' '), sum(end - start for (start, end) in spans),
+            len(commands)), is_debug=True)
+    log('Paused the game for {0:.1f} ms.'.format(paused * 1000),
+        is_debug=True)
 
+    if DEBUG:
+        # The game is running again, so a difference here may be a change
+        # the player made in the meantime. The writes have gone out either
+        # way, so it is only reported; the next poll picks up real changes.
+        try:
+            verify_inventory = Inventory.from_items(
+                *get_field_items(get_field_items_raw()))
+        except IOError:
+            log('Unable to verify the write.', is_debug=True)
+            return True
+        if verify_inventory == inventory:
+            log('The write was successful.', is_debug=True)
+        else:
+            log('ALERT: The inventory differs after the write!',
+                is_debug=True)
+            error_dict = {
+                k: (inventory[k], verify_inventory[k])
+                for (k, _) in inventory.diff(verify_inventory)
+                }
+            log(error_dict)
+    return True
 
-def get_played_time():
-    data = get_retroarch_data(PLAYED_TIME_ADDRESS, 4)
+
+def get_played_time(data=None):
+    if data is None:
+        data = get_retroarch_data(PLAYED_TIME_ADDRESS, 4)
     hours, minutes, seconds, frames = data
     frames -= 1
     assert 0 <= frames <= 59
@@ -370,8 +924,9 @@ def get_played_time():
     return frames
 
 
-def get_battle_characters():
-    data = get_retroarch_data(BATTLE_CHAR_ADDRESS, 8)
+def get_battle_characters(data=None):
+    if data is None:
+        data = get_retroarch_data(BATTLE_CHAR_ADDRESS, 8)
     characters = []
     for i in range(4):
         a, b = data[i*2:(i+1)*2]
@@ -382,9 +937,11 @@ def get_battle_characters():
     return characters
 
 
-def get_status_data():
-    status1 = get_retroarch_data(STATUS_1_ADDRESS, 8)
-    status2 = get_retroarch_data(STATUS_2_ADDRESS, 8)
+def get_status_data(status1=None, status2=None):
+    if status1 is None:
+        status1 = get_retroarch_data(STATUS_1_ADDRESS, 8)
+    if status2 is None:
+        status2 = get_retroarch_data(STATUS_2_ADDRESS, 8)
     char_statuses = {}
     for i in range(4):
         a = status1[i*2] | status1[(i*2)+1]
@@ -393,7 +950,7 @@ def get_status_data():
     return char_statuses
 
 
-def write_status(char_statuses):
+def write_status(char_statuses, ram):
     status1, status2 = [], []
     for i, char_status in sorted(char_statuses.items()):
         if char_status is None:
@@ -405,89 +962,182 @@ def write_status(char_statuses):
         status1 += [a & 0xFF, a >> 8]
         status2 += [b & 0xFF, b >> 8]
 
-    write_retroarch_data(STATUS_1_ADDRESS, status1)
-    write_retroarch_data(STATUS_2_ADDRESS, status2)
+    ram.write('status_1', status1)
+    ram.write('status_2', status2)
 
 
-def get_chest_data():
-    data = get_retroarch_data(CHEST_ADDRESS, 0x40)
-    return data
-
-
-def write_chests(old_chests, new_chests):
-    to_write = []
-    assert len(old_chests) == len(new_chests)
-    for (a, b) in zip(old_chests, new_chests):
-        assert 0 <= a <= 0xFF
-        assert 0 <= b <= 0xFF
-        to_write.append(a | b)
-    assert len(to_write) == 0x40
+def write_chests(new_chests, ram):
+    # new_chests maps chest bytes to the bits to set in them
+    to_write = bytearray(ram.chests)
+    for (i, bits) in new_chests.items():
+        assert 0 <= bits <= 0xFF
+        to_write[i] |= bits
 
     if SYNC_CHESTS:
-        write_retroarch_data(CHEST_ADDRESS, to_write)
+        ram.write('chests', to_write)
 
 
-def get_gp():
-    data = get_retroarch_data(GP_ADDRESS, 3)
+def get_gp(data=None):
+    if data is None:
+        data = get_retroarch_data(GP_ADDRESS, 3)
     return (data[2] << 16) | (data[1] << 8) | data[0]
 
 
-def get_server_directive():
-    response = server_receive()
+def receive_server_responses():
+    # runs in its own thread, so a slow server never holds up RAM polling
+    while True:
+        try:
+            response = server_receive()
+        except socket.timeout:
+            continue
+        except ConnectionError as e:
+            response = e
+        except Exception:
+            # a datagram that cannot be decoded is dropped on its own
+            log('Bad response from server: {0}: {1}'.format(
+                *exc_info()[:2]))
+            continue
+        if response != []:
+            server_responses.put(response)
+
+
+def get_server_directives(timeout):
+    # wait until something arrives from the server or the timeout
+    # passes, then take everything else that has arrived
+    responses = []
     try:
-        directive, parameters = response.split(' ', 1)
-        parameters = json.loads(parameters)
-        parameters = convert_dict_keys_to_int(parameters)
-    except:
-        log('Bad directive: {0}'.format(response))
-        raise Exception(response)
+        responses.append(server_responses.get(timeout=max(timeout, 0)))
+        while True:
+            responses.append(server_responses.get_nowait())
+    except Empty:
+        pass
+
+    directives, error = [], None
+    for response in responses:
+        if isinstance(response, ConnectionError):
+            error = response
+        elif isinstance(response, list):
+            directives.extend(parse_server_directive(r) for r in response)
+        else:
+            directives.append(parse_server_directive(response))
+    if error is not None and not directives:
+        raise error
+    return directives
+
+
+def parse_server_directive(response):
+    if isinstance(response, tuple):
+        directive, parameters, push_sequence = response
+        response = '{0} {1}'.format(directive, parameters)
+        if directive in ('Success', 'ERROR'):
+            log('Bad directive: {0}'.format(response))
+            raise Exception(response)
+    else:
+        push_sequence = None
+        if response.startswith('PUSH '):
+            _, push_sequence, response = response.split(' ', 2)
+            push_sequence = int(push_sequence)
+        try:
+            directive, parameters = response.split(' ', 1)
+            parameters = json.loads(parameters)
+            parameters = convert_dict_keys_to_int(parameters)
+        except:
+            log('Bad directive: {0}'.format(response))
+            raise Exception(response)
 
     if DEBUG:
         log('Received {0} from server.'.format(response), is_debug=True)
     else:
         log('Received {0} from server.'.format(directive))
-    return directive, parameters
+    return directive, parameters, push_sequence
 
 
 def pause_retroarch():
     if PAUSE_DELAY_INTERVAL <= 0:
         return
     cmd = b'FRAMEADVANCE'
-    retroarch_socket.send(cmd)
+    retroarch_send(cmd)
 
 
 def toggle_pause_retroarch():
     if PAUSE_DELAY_INTERVAL <= 0:
         return
     cmd = b'PAUSE_TOGGLE'
-    retroarch_socket.send(cmd)
+    retroarch_send(cmd)
 
 
 def send_change_queue():
-    temp = list(change_queue)
-    while True:
-        payload = json.dumps(temp)
-        msg = 'LOG {0} {1}'.format(SERIES_NUMBER, payload)
-        if len(msg) > 4095:
-            temp = temp[:len(temp)/2]
+    # halve the queue until every part fits in a datagram, then send
+    # all of the parts
+    parts = [list(change_queue)]
+    while parts:
+        temp = parts.pop(0)
+        if binary_protocol:
+            msg = encode_packet('LOG', pack_change_queue(temp))
+        else:
+            payload = json.dumps(temp)
+            msg = 'LOG {0} {1}'.format(SERIES_NUMBER, payload)
+        if len(msg) >= MAX_DATAGRAM_SIZE and len(temp) > 1:
+            half = len(temp) // 2
+            parts[:0] = [temp[:half], temp[half:]]
         else:
             server_send(msg)
-            break
 
 
 def send_chests(chests):
-    msg = 'CHESTS {0} {1}'.format(SERIES_NUMBER, json.dumps(chests))
+    if binary_protocol:
+        msg = encode_packet('CHESTS', b''.join(
+            CHEST_ENTRY.pack(i, bits) for (i, bits) in chests.items()))
+    else:
+        msg = 'CHESTS {0} {1}'.format(SERIES_NUMBER,
+                                      json.dumps(list(chests)))
     server_send(msg)
 
 
-def check_inventory_size(inventory):
-    count = 0
-    for (item, amount) in inventory.items():
-        if item == 0xFF:
-            continue
-        if 1 <= amount <= 99:
-            count += 1
-    return count
+def get_chest_uploads(current_chests, previous_chests):
+    # Chest bits set here since the last poll are uploaded until a chest
+    # delta from the server shows it has them.
+    for (i, (a, b)) in enumerate(zip(current_chests, previous_chests)):
+        unconfirmed_chests[i] |= a & (0xFF ^ b)
+    uploads = {}
+    for i in range(0x40):
+        unconfirmed_chests[i] &= 0xFF ^ session_chests[i]
+        if unconfirmed_chests[i]:
+            uploads[i] = unconfirmed_chests[i]
+    return uploads
+
+
+def apply_chest_delta(base, version, chests):
+    global chest_version
+    if base == 0:
+        session_chests[:] = bytes(0x40)
+    # the bytes are the server's own, so they can be merged even from a
+    # delta that arrives out of order
+    for (i, bits) in convert_dict_keys_to_int(chests).items():
+        session_chests[i] |= bits
+    if base == 0 or base <= chest_version < version:
+        chest_version = version
+
+
+def apply_ledger_delta(epoch, base, version, items):
+    # A delta holds the current amount of every item changed since its
+    # base, so any delta that starts at or before our version brings us
+    # up to date. Pushes sent in a burst share a base and overlap.
+    global ledger_epoch, ledger_version, session_ledger, force_sync
+    if base == 0:
+        session_ledger = array('i', [0]) * 0x100
+    elif epoch != ledger_epoch or base > ledger_version:
+        log('Discarded out of order inventory delta.', is_debug=True)
+        force_sync = True
+        return None
+    elif version <= ledger_version:
+        # older than one already applied
+        return None
+
+    for (item, amount) in convert_dict_keys_to_int(items).items():
+        session_ledger[item] = amount
+    ledger_epoch, ledger_version = epoch, version
+    return array('i', session_ledger)
 
 
 def main_loop():
@@ -495,28 +1145,40 @@ def main_loop():
     global previous_inventory, previous_played_time
     global previous_status, previous_chests, previous_gp
     global backoff_sync_interval, previous_sync_request, force_sync
-    global retroarch_socket
-
-    directive, directive_parameters = None, None
+    global retroarch_socket, subscribed_until, applied_pushes
+    global versioned_server, unanswered_forced_syncs
+    global unanswered_subscriptions, unapplied_directives
+    global previous_poll_time
+
+    # Poll RetroArch every POLL_INTERVAL, or sooner when the server sends
+    # something. Directives kept from a poll that could not read RetroArch
+    # come first.
+    directives, unapplied_directives = unapplied_directives, []
     try:
-        directive, directive_parameters = get_server_directive()
+        directives += get_server_directives(
+            previous_poll_time + POLL_INTERVAL - time())
     except ConnectionError:
         log('Unable to connect to server.')
-    except socket.timeout:
-        pass
+    previous_poll_time = time()
+    directive_names = {directive for (directive, _, _) in directives}
+    tick_profiler.mark('directive')
 
     try:
         # read RAM data from retroarch
-        played_time = get_played_time()
+        force = set()
+        if directive_names & {'SYNC', 'DELTA', 'REPORT'}:
+            force.add('field_items')
+        if directive_names & {'CHESTS', 'CHEST_DELTA'}:
+            force.add('chests')
+        ram = poll_scheduler.poll(force)
+        played_time = get_played_time(ram['played_time'])
         if played_time < MINIMUM_PLAYED_TIME:
             previous_played_time = 999999999
-        field_raw = get_field_items_raw()
-        battle_raw = get_battle_items_raw()
-
-        battle_characters = get_battle_characters()
-        current_status = get_status_data()
+        battle_characters = get_battle_characters(ram['battle_characters'])
+        current_status = ram.statuses
 
-        current_chests = get_chest_data()
+        current_chests = ram.chests
+        current_gp = get_gp(ram['gp'])
     except (IOError, AssertionError):
         log('{0}: {1}'.format(*exc_info()[:2]))
         retroarch_socket.close()
@@ -524,36 +1186,49 @@ def main_loop():
         retroarch_socket.connect(('localhost', RETROARCH_PORT))
         retroarch_socket.settimeout(POLL_INTERVAL / 5.0)
         force_sync = True
+        unapplied_directives = directives
         return
+    tick_profiler.mark('read')
 
     now = time()
-    if now - previous_sync_request > backoff_sync_interval:
+    if (now - previous_sync_request > backoff_sync_interval
+            or (force_sync and now - previous_sync_request > SYNC_INTERVAL)):
         send_sync_request()
         previous_sync_request = now
+        sync_requested = True
+    else:
+        sync_requested = False
+    tick_profiler.mark('send')
 
     chests_opened = False
     if previous_chests is None:
         previous_chests = current_chests
     elif previous_chests != current_chests:
         chests_opened = True
+    chest_uploads = {}
+    if binary_protocol and (chests_opened or sync_requested):
+        # unconfirmed bits are sent again along with each sync request
+        chest_uploads = get_chest_uploads(current_chests, previous_chests)
 
-    current_gp = get_gp()
     if previous_gp is None:
         previous_gp = current_gp
 
-    field_items = get_field_items(field_raw)
-    battle_items = get_battle_items(battle_raw)
+    field_items = ram.field_items
+    battle_items = ram.battle_items
 
     # determine whether the game is currently in combat
-    similarity = calculate_similarity(field_items, battle_items)
-    if similarity > SIMILARITY_THRESHOLD:
+    if 'battle_items' in poll_scheduler.fresh:
+        similarity = calculate_similarity(field_items, battle_items)
+    else:
+        similarity = 0
+    poll_scheduler.in_battle = similarity > SIMILARITY_THRESHOLD
+    if poll_scheduler.in_battle:
         in_battle = True
-        current_order, current_inventory = items_to_dict(battle_items)
-        raw_data = battle_raw
+        current_inventory = parse_inventory(*map(bytes, battle_items))
     else:
         in_battle = False
-        current_order, current_inventory = items_to_dict(field_items)
-        raw_data = field_raw
+        current_inventory = parse_inventory(*map(bytes, field_items))
+    tick_profiler.mark('similarity')
 
     # if in combat, determine changed statuses
     if in_battle:
@@ -578,26 +1253,22 @@ def main_loop():
 
     # sanity check to prevent inventory wipe on re-load
     if (previous_inventory is not None and current_inventory is not None
-            and check_inventory_size(previous_inventory) >= MIN_SANE_INVENTORY
-            and check_inventory_size(current_inventory) <= 0):
+            and previous_inventory.count_items() >= MIN_SANE_INVENTORY
+            and current_inventory.count_items() <= 0):
         previous_played_time = 999999999
 
     # sync field to battle inventory to always stay above threshold
     if in_battle and similarity < 1.0:
-        sync_field_battle(current_order, current_inventory)
+        sync_field_battle(current_inventory, ram)
 
     # update change queue
     if SYNC_INVENTORY:
         if (previous_inventory is not None
                 and played_time > previous_played_time
                 and current_inventory != previous_inventory):
-            for item in sorted(set(previous_inventory.keys())
-                               | set(current_inventory.keys())):
-                if previous_inventory[item] != current_inventory[item]:
-                    message_index += 1
-                    change_queue.append((
-                        message_index, item,
-                        current_inventory[item]-previous_inventory[item]))
+            for (item, change) in current_inventory.diff(previous_inventory):
+                message_index += 1
+                change_queue.append((message_index, item, change))
 
     # update change queue (statuses)
     if status_on is not None and status_off is not None:
@@ -619,24 +1290,46 @@ def main_loop():
 
     synced_inventory = None
     synced_status = {}
-    update_status_flag = False
-    if directive is not None:
-        backoff_sync_interval = SYNC_INTERVAL
+    for (directive, directive_parameters, push_sequence) in directives:
+        if push_sequence is not None and push_sequence in applied_pushes:
+            # a retransmission of an update that was already applied
+            send_push_ack(push_sequence)
+            continue
+
+        if directive == 'SUBSCRIBED':
+            timeout, server_push_sequence = directive_parameters
+            subscribed_until = time() + timeout
+            unanswered_subscriptions = 0
+            backoff_sync_interval = min(KEEPALIVE_INTERVAL, timeout / 3.0)
+            # the server restarted and is numbering its updates anew
+            applied_pushes = [sequence for sequence in applied_pushes
+                              if sequence <= server_push_sequence]
+        elif time() >= subscribed_until:
+            backoff_sync_interval = SYNC_INTERVAL
+        if directive in ('SYNC', 'DELTA', 'REPORT'):
+            unanswered_forced_syncs = 0
+        new_inventory = None
         if directive == 'SYNC':
-            synced_inventory = directive_parameters
-            for item in range(0x100):
-                if item not in synced_inventory:
-                    synced_inventory[item] = 0
+            new_inventory = array('i', [0]) * 0x100
+            for (item, amount) in directive_parameters.items():
+                new_inventory[item] = amount
+            if versioned_server is None:
+                versioned_server = False
+        if directive == 'DELTA':
+            new_inventory = apply_ledger_delta(*directive_parameters)
+            versioned_server = True
+        if new_inventory is not None:
             for (index, item, change) in change_queue:
                 if isinstance(index, int):
-                    synced_inventory[item] += change
+                    new_inventory[item] += change
+            synced_inventory = new_inventory
         if directive == 'REPORT':
-            temp_inventory = {}
-            for item, amount in current_inventory.items():
-                if amount >= 1:
-                    temp_inventory[item] = amount
-            payload = json.dumps(temp_inventory)
-            msg = 'REPORT {0} {1}'.format(SERIES_NUMBER, payload)
+            if binary_protocol:
+                msg = encode_packet(
+                    'REPORT', pack_inventory(current_inventory.as_dict()))
+            else:
+                payload = json.dumps(current_inventory.as_dict())
+                msg = 'REPORT {0} {1}'.format(SERIES_NUMBER, payload)
             server_send(msg)
         if directive == 'LOG':
             indexes = directive_parameters
@@ -645,24 +1338,45 @@ def main_loop():
                             if index not in indexes]
         if directive == 'CHESTS':
             synced_chests = directive_parameters
-            write_chests(current_chests, synced_chests)
-
-        if in_battle and directive in ['STATUS_ON', 'STATUS_OFF']:
-            character, change = directive_parameters
-            change = int(change, 0x10)
-            for i in range(4):
-                synced_status[i] = current_status[i]
-                if current_status[i] is not None:
-                    value = current_status[i]
-                    if i == character:
-                        if directive == 'STATUS_ON':
-                            value |= change
-                        elif directive == 'STATUS_OFF':
-                            value &= (0xFFFFFFFF ^ change)
-
-                    if value != current_status[i]:
-                        update_status_flag = True
-                        synced_status[i] = value
+            write_chests(dict(enumerate(synced_chests)), ram)
+        if directive == 'CHEST_DELTA':
+            apply_chest_delta(*directive_parameters)
+            write_chests(directive_parameters[2], ram)
+
+        if in_battle and directive in ['STATUS_ON', 'STATUS_OFF', 'STATUS']:
+            # STATUS holds [character, flags set, flags cleared] for each
+            # character that changed
+            if directive == 'STATUS':
+                status_changes = directive_parameters
+            else:
+                character, change = directive_parameters
+                change = int(change, 0x10)
+                if directive == 'STATUS_ON':
+                    status_changes = [(character, change, 0)]
+                else:
+                    status_changes = [(character, 0, change)]
+            if not synced_status:
+                synced_status = {i: current_status[i] for i in range(4)}
+            for (character, set_mask, clear_mask) in status_changes:
+                value = synced_status.get(character)
+                if value is not None:
+                    value |= set_mask
+                    value &= (0xFFFFFFFF ^ clear_mask)
+                    synced_status[character] = value
+
+        if push_sequence is not None:
+            # remember recent pushes rather than only the newest, since a
+            # lost one can be retransmitted after later ones have arrived
+            applied_pushes.append(push_sequence)
+            applied_pushes = applied_pushes[-PUSH_WINDOW:]
+            try:
+                send_push_ack(push_sequence)
+            except ConnectionError:
+                log('Unable to connect to server.')
+    update_status_flag = any(synced_status[i] != current_status[i]
+                             for i in synced_status)
+
+    tick_profiler.mark('apply')
 
     if change_queue:
         try:
@@ -673,21 +1387,27 @@ def main_loop():
                         for (index, item, change) in change_queue
                         if isinstance(index, int)]
 
-    if SYNC_CHESTS and chests_opened:
+    if SYNC_CHESTS and binary_protocol:
+        if chest_uploads:
+            send_chests(chest_uploads)
+        previous_chests = current_chests
+    elif SYNC_CHESTS and chests_opened:
         try:
             send_chests(current_chests)
             previous_chests = current_chests
         except ConnectionError:
             log('Unable to connect to server.')
+    try:
+        send_server_packets()
+    except ConnectionError:
+        log('Unable to connect to server.')
+    tick_profiler.mark('send')
 
     if SYNC_INVENTORY and synced_inventory is not None:
-        simplified_inventory = {k:v for (k, v) in synced_inventory.items()
-                                if v > 0}
-        simplified_current = {k:v for (k, v) in current_inventory.items()
-                              if v > 0}
-        log('Inventory write attempt: {0}'.format(simplified_inventory),
+        synced_inventory = current_inventory.merge(synced_inventory)
+        log('Inventory write attempt: {0}'.format(synced_inventory.as_dict()),
             is_debug=True)
-        if simplified_inventory == simplified_current:
+        if synced_inventory == current_inventory:
             log('The new inventory is THE SAME as the old inventory.',
                 is_debug=True)
             previous_inventory = current_inventory
@@ -698,8 +1418,7 @@ def main_loop():
             log('The new inventory is DIFFERENT from the old inventory.',
                 is_debug=True)
             try:
-                if write_inventory(current_order, synced_inventory,
-                                   raw_data, in_battle=in_battle):
+                if write_inventory(synced_inventory, ram, in_battle=in_battle):
                     previous_inventory = synced_inventory
                     if previous_played_time > played_time:
                         previous_played_time = played_time
@@ -707,36 +1426,98 @@ def main_loop():
                     force_sync = True
             except socket.timeout:
                 pass
+        tick_profiler.mark('write')
 
     if update_status_flag:
-        write_status(synced_status)
+        write_status(synced_status, ram)
 
 
-def create_new_session(name):
-    server_send('NEW {0} {1}'.format(name, SERIES_NUMBER))
+def open_session(command, name, offer_binary=BINARY_PROTOCOL):
+    # Servers that speak the binary protocol answer the offer with a
+    # binary packet; older ones reject the extra word, so ask again.
+    global binary_protocol
+    msg = '{0} {1} {2}'.format(command, name, SERIES_NUMBER)
+    if offer_binary:
+        msg = '{0} {1}'.format(msg, BINARY_OFFER)
+    server_send(msg)
     server_socket.settimeout(30)
     msg = server_receive()
-    if msg.startswith('ERROR'):
+    if isinstance(msg, list):
+        directive, parameters, _ = msg[0]
+        if directive != 'Success':
+            raise Exception('ERROR: {0}'.format(parameters))
+        binary_protocol = True
+        log('Using the binary protocol.')
+        # anything sent along with the reply is handled by main_loop
+        server_responses.put(msg[1:])
+    elif msg.startswith('ERROR'):
+        if offer_binary:
+            return open_session(command, name, offer_binary=False)
         raise Exception(msg)
 
 
+def create_new_session(name):
+    open_session('NEW', name)
+
+
 def join_session(name):
-    server_send('JOIN {0} {1}'.format(name, SERIES_NUMBER))
-    server_socket.settimeout(30)
-    msg = server_receive()
-    if msg.startswith('ERROR'):
-        raise Exception(msg)
+    open_session('JOIN', name)
 
 
 def send_sync_request():
-    global backoff_sync_interval, force_sync
-    backoff_sync_interval *= 1.5
-    backoff_sync_interval = min(backoff_sync_interval, SYNC_INTERVAL * 10)
-    if previous_played_time >= 999999999 or force_sync:
-        server_send('SYNC {0} !'.format(SERIES_NUMBER))
-        force_sync = False
+    global backoff_sync_interval, force_sync, unanswered_subscriptions
+    global unanswered_forced_syncs
+    if time() >= subscribed_until:
+        backoff_sync_interval *= 1.5
+        backoff_sync_interval = min(backoff_sync_interval,
+                                    SYNC_INTERVAL * 10)
+    # Servers without push support ignore SUBSCRIBE, so a SYNC goes along
+    # with it once one has gone unanswered, and after three the client
+    # only polls with SYNC. It still tries SUBSCRIBE every so often in
+    # case the server was only down for a while.
+    commands = []
+    if PUSH_UPDATES and (unanswered_subscriptions < 3 or
+                         unanswered_subscriptions % SUBSCRIBE_RETRY == 0):
+        commands.append('SUBSCRIBE')
+    if not PUSH_UPDATES or unanswered_subscriptions > 0:
+        commands.append('SYNC')
+    unanswered_subscriptions += 1
+    forced = previous_played_time >= 999999999 or force_sync
+    force_sync = False
+    # Old servers only send a full inventory for a bare !, and newer ones
+    # answer it without a version. Until a reply shows which kind of
+    # server this is, unanswered forced syncs alternate the two forms.
+    bare_force = versioned_server is False or (
+        versioned_server is None and unanswered_forced_syncs % 2 == 1)
+    if forced:
+        unanswered_forced_syncs += 1
+    for command in commands:
+        if binary_protocol:
+            if forced:
+                epoch, version = 0, 0
+            else:
+                epoch, version = ledger_epoch, ledger_version
+            server_send(encode_packet(command, struct.pack(
+                '>III', epoch, version, chest_version)))
+        elif forced and bare_force:
+            server_send('{0} {1} !'.format(command, SERIES_NUMBER))
+        elif forced:
+            server_send('{0} {1} @0:0 !'.format(command, SERIES_NUMBER))
+        else:
+            server_send('{0} {1} @{2}:{3}'.format(
+                command, SERIES_NUMBER, ledger_epoch, ledger_version))
+
+
+def send_push_ack(push_sequence):
+    # the ack also tells the server which ledger and chest versions we
+    # now have
+    if binary_protocol:
+        server_send(encode_packet('ACK', struct.pack(
+            '>III', ledger_epoch, ledger_version, chest_version),
+            push_sequence))
     else:
-        server_send('SYNC {0}'.format(SERIES_NUMBER))
+        server_send('ACK {0} {1} @{2}:{3}'.format(
+            SERIES_NUMBER, push_sequence, ledger_epoch, ledger_version))
 
 
 if __name__ == '__main__':
@@ -789,16 +1570,13 @@ if __name__ == '__main__':
         elif option == OPTION_NEW_SESSION:
             create_new_session(session_name)
 
-        previous_network_time = 0
+        poll_scheduler = PollScheduler()
+        tick_profiler = TickProfiler(PROFILE_WINDOW)
+        Thread(target=receive_server_responses, daemon=True).start()
         while True:
-            now = time()
-            diff = now - previous_network_time
-            if diff < POLL_INTERVAL:
-                sleep(POLL_INTERVAL - diff)
-                now = time()
-            previous_network_time = now
-
+            tick_profiler.start_tick()
             main_loop()
+            tick_profiler.end_tick()
 
     except:
         traceback.print_exc()
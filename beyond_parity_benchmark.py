@@ -0,0 +1,189 @@
+import argparse
+import json
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from configparser import ConfigParser
+from os import path
+from time import sleep
+
+DEFAULT_SCRIPT = '''# seconds from start, then a game event
+2 GAIN 0x01 3
+4 USE 0xe8 2
+6 BATTLE START
+7 STATUS 0 ON 4
+8 USE 0xe9 1
+9 STATUS 0 OFF 4
+11 BATTLE END
+13 CHEST 3 0x10
+15 GAIN 0x20 2
+'''
+SESSION_NAME = 'benchmark'
+
+here = path.dirname(path.abspath(__file__))
+
+
+def start_script(name, arguments, log_filename, cwd=None, stdin=None):
+    log_file = open(log_filename, 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-u', path.join(here, name)] + arguments,
+        stdin=stdin, stdout=log_file, stderr=subprocess.STDOUT, cwd=cwd)
+    log_file.close()
+    return process
+
+
+def write_client_config(base_config, filename, server_port, retroarch_port,
+                        join_session, report_interval):
+    config = ConfigParser()
+    config.optionxform = str
+    config.read(base_config)
+    settings = config['Settings']
+    settings['SERVER_HOSTNAME'] = '127.0.0.1'
+    settings['SERVER_PORT'] = str(server_port)
+    settings['RETROARCH_PORT'] = str(retroarch_port)
+    settings['JOIN_SESSION_NAME'] = SESSION_NAME if join_session else ''
+    settings['PROFILE_INTERVAL'] = str(report_interval)
+    settings['PROFILE_WINDOW'] = '100000'
+    f = open(filename, 'w')
+    config.write(f)
+    f.close()
+
+
+def get_emulator_stats(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(2)
+    s.sendto(b'STATS', ('127.0.0.1', port))
+    try:
+        return json.loads(s.recv(0x10000))
+    except socket.timeout:
+        return None
+    finally:
+        s.close()
+
+
+def get_tick_profile(log_filename):
+    # the last profile report from a client log, without timestamps
+    report = []
+    f = open(log_filename)
+    for line in f:
+        line = line.rstrip('\n').split(' ', 2)[-1]
+        if line.startswith('Tick profile'):
+            report = [line]
+        elif report and (line.startswith('  ')
+                         or line.startswith('RetroArch per tick')
+                         or line.startswith('Write pauses')):
+            report.append(line)
+    f.close()
+    return report
+
+
+def run_benchmark(args, directory):
+    script_filename = args.script
+    if script_filename is None:
+        script_filename = path.join(directory, 'script.txt')
+        f = open(script_filename, 'w')
+        f.write(DEFAULT_SCRIPT)
+        f.close()
+
+    processes = []
+    server = start_script(
+        'beyond_parity_server.py',
+        ['--address', '127.0.0.1', '--port', str(args.server_port)],
+        path.join(directory, 'server.log'), cwd=directory)
+    processes.append(server)
+    clients = []
+    try:
+        for i in range(args.clients):
+            retroarch_port = args.retroarch_port + i
+            emulator_arguments = [
+                args.config, '--port', str(retroarch_port),
+                '--latency', str(args.latency), '--jitter', str(args.jitter),
+                '--script', script_filename, '--loop']
+            processes.append(start_script(
+                'beyond_parity_emulator.py', emulator_arguments,
+                path.join(directory, 'emulator_{0}.log'.format(i))))
+        sleep(1)
+
+        for i in range(args.clients):
+            config_filename = path.join(directory, 'client_{0}.cfg'.format(i))
+            write_client_config(args.config, config_filename,
+                                args.server_port, args.retroarch_port + i,
+                                i > 0, args.report_interval)
+            client = start_script(
+                'beyond_parity.py', [config_filename],
+                path.join(directory, 'client_{0}.log'.format(i)),
+                stdin=subprocess.PIPE)
+            if i == 0:
+                # the first client creates the session
+                client.stdin.write('2\n{0}\n'.format(SESSION_NAME).encode())
+                client.stdin.flush()
+                sleep(1)
+            processes.append(client)
+            clients.append(client)
+
+        sleep(args.duration)
+        results = [get_emulator_stats(args.retroarch_port + i)
+                   for i in range(args.clients)]
+    finally:
+        for process in processes[1:]:
+            process.kill()
+        server.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+
+    for i in range(args.clients):
+        print('Client {0}:'.format(i))
+        for line in get_tick_profile(
+                path.join(directory, 'client_{0}.log'.format(i))):
+            print('  {0}'.format(line))
+        emulator_stats = results[i]
+        if emulator_stats is None:
+            print('  The emulator did not answer.')
+            continue
+        print('  RetroArch commands: {0}'.format(', '.join(
+            '{0} {1}'.format(command, emulator_stats.get(command, 0))
+            for command in ('READ_CORE_RAM', 'WRITE_CORE_RAM',
+                            'FRAMEADVANCE', 'PAUSE_TOGGLE'))))
+        print('  RetroArch bytes: {0} received, {1} sent'.format(
+            emulator_stats.get('bytes_received', 0),
+            emulator_stats.get('bytes_sent', 0)))
+        if emulator_stats['pauses']:
+            print('  Write window (ms): mean {0:.1f}, p90 {1:.1f}, '
+                  'max {2:.1f} over {3} pauses'.format(
+                      emulator_stats['pause_mean'] * 1000,
+                      emulator_stats['pause_p90'] * 1000,
+                      emulator_stats['pause_max'] * 1000,
+                      emulator_stats['pauses']))
+        print('  Writes while running: {0}, while paused: {1}'.format(
+            emulator_stats.get('writes_running', 0),
+            emulator_stats.get('writes_paused', 0)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run the server, emulated RetroArch instances and '
+                    'clients locally and report client timings.')
+    parser.add_argument('config', nargs='?',
+                        default=path.join(here, 'beyond_parity.cfg'))
+    parser.add_argument('--clients', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--report-interval', type=float, default=5)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--script', help='file of timed game events')
+    parser.add_argument('--server-port', type=int, default=55433)
+    parser.add_argument('--retroarch-port', type=int, default=55455)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the logs and server state')
+    args = parser.parse_args()
+
+    if args.keep:
+        directory = tempfile.mkdtemp(prefix='beyond_parity_benchmark_')
+        run_benchmark(args, directory)
+        print('Logs are in {0}'.format(directory))
+    else:
+        with tempfile.TemporaryDirectory(
+                prefix='beyond_parity_benchmark_') as directory:
+            run_benchmark(args, directory)
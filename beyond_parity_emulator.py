@@ -0,0 +1,344 @@
+import argparse
+import heapq
+import json
+import random
+import socket
+from collections import defaultdict
+from configparser import ConfigParser
+from time import time
+
+FRAME_INTERVAL = 1 / 60.0
+WRAM_ADDRESS = 0x7e0000
+WRAM_SIZE = 0x20000
+EMPTY_SLOT = 0xFF
+REGION_LENGTHS = {
+    'FIELD_ITEM_ADDRESS': 512,
+    'BATTLE_ITEM_ADDRESS': 1280,
+    'PLAYED_TIME_ADDRESS': 4,
+    'BATTLE_CHAR_ADDRESS': 8,
+    'STATUS_1_ADDRESS': 8,
+    'STATUS_2_ADDRESS': 8,
+    'CHEST_ADDRESS': 0x40,
+    'GP_ADDRESS': 3,
+    'BUTTON_MAP_ADDRESS': 4,
+    }
+DEFAULT_BUTTON_MAP = bytes([0x12, 0x34, 0x56, 0x06])
+DEFAULT_INVENTORY = {
+    0x01: 2, 0x0b: 1, 0x1d: 1, 0x5a: 3, 0xe7: 1, 0xe8: 12, 0xe9: 4,
+    0xea: 2, 0xec: 1, 0xf0: 6, 0xf5: 1, 0xf6: 2, 0xfd: 5,
+    }
+
+addresses = {}
+wram = bytearray(WRAM_SIZE)
+emulator_socket = None
+paused = False
+in_battle = False
+pause_started = None
+pending_replies = []
+pending_events = []
+script_events = []
+script_position = 0
+script_started = 0
+stats = defaultdict(int)
+pause_windows = []
+
+
+def load_addresses(filename):
+    config = ConfigParser()
+    config.read(filename)
+    for key in REGION_LENGTHS:
+        addresses[key] = int(config.get('Settings', key), 0x10)
+
+
+def get_region(key):
+    start = addresses[key] - WRAM_ADDRESS
+    return start, start + REGION_LENGTHS[key]
+
+
+def initialize_wram():
+    start, end = get_region('BUTTON_MAP_ADDRESS')
+    wram[start:end] = DEFAULT_BUTTON_MAP
+    start, end = get_region('PLAYED_TIME_ADDRESS')
+    wram[start:end] = bytes([1, 0, 0, 1])
+    start, end = get_region('BATTLE_CHAR_ADDRESS')
+    wram[start:end] = bytes([0xFF]) * (end - start)
+    start, end = get_region('GP_ADDRESS')
+    wram[start:end] = (1000).to_bytes(3, 'little')
+
+    start, end = get_region('FIELD_ITEM_ADDRESS')
+    wram[start:start+0x100] = bytes([EMPTY_SLOT]) * 0x100
+    for (slot, (item, amount)) in enumerate(sorted(
+            DEFAULT_INVENTORY.items())):
+        wram[start+slot] = item
+        wram[start+0x100+slot] = amount
+
+
+def advance_frames(frames):
+    start, _ = get_region('PLAYED_TIME_ADDRESS')
+    hours, minutes, seconds, frame = wram[start:start+4]
+    total = frame - 1 + (60 * (seconds + (60 * (minutes + (60 * hours)))))
+    total += frames
+    frame, total = (total % 60) + 1, total // 60
+    seconds, total = total % 60, total // 60
+    minutes, hours = total % 60, min(total // 60, 0xFF)
+    wram[start:start+4] = bytes([hours, minutes, seconds, frame])
+    stats['frames'] += frames
+
+
+def get_inventory_layout():
+    # returns (address of the first slot, bytes per slot, amount offset)
+    if in_battle:
+        start, _ = get_region('BATTLE_ITEM_ADDRESS')
+        return start, 5, 3
+    start, _ = get_region('FIELD_ITEM_ADDRESS')
+    return start, 1, 0x100
+
+
+def change_item(item, change):
+    start, step, amount_offset = get_inventory_layout()
+    items = wram[start:start+(0x100*step):step]
+    if item in items:
+        slot = items.index(item)
+    elif change > 0 and EMPTY_SLOT in items:
+        slot = items.index(EMPTY_SLOT)
+    else:
+        return
+
+    address = start + (slot * step)
+    amount = max(0, min(99, wram[address+amount_offset] + change))
+    wram[address] = item if amount else EMPTY_SLOT
+    wram[address+amount_offset] = amount
+
+
+def set_battle(active):
+    global in_battle
+    field_start, _ = get_region('FIELD_ITEM_ADDRESS')
+    battle_start, battle_end = get_region('BATTLE_ITEM_ADDRESS')
+    characters_start, characters_end = get_region('BATTLE_CHAR_ADDRESS')
+    if active and not in_battle:
+        for slot in range(0x100):
+            battle_slot = battle_start + (slot * 5)
+            wram[battle_slot:battle_slot+5] = bytes([
+                wram[field_start+slot], 0, 0, wram[field_start+0x100+slot],
+                0])
+        wram[characters_start:characters_end] = bytes(
+            characters_end - characters_start)
+    elif in_battle and not active:
+        for slot in range(0x100):
+            battle_slot = battle_start + (slot * 5)
+            wram[field_start+slot] = wram[battle_slot]
+            wram[field_start+0x100+slot] = wram[battle_slot+3]
+        wram[battle_start:battle_end] = bytes(battle_end - battle_start)
+        wram[characters_start:characters_end] = bytes(
+            [0xFF]) * (characters_end - characters_start)
+        for key in ('STATUS_1_ADDRESS', 'STATUS_2_ADDRESS'):
+            start, end = get_region(key)
+            wram[start:end] = bytes(end - start)
+    in_battle = active
+
+
+def change_status(character, flags, on):
+    status_1, _ = get_region('STATUS_1_ADDRESS')
+    status_2, _ = get_region('STATUS_2_ADDRESS')
+    status_1 += character * 2
+    status_2 += character * 2
+    value = (int.from_bytes(wram[status_1:status_1+2], 'little')
+             | (int.from_bytes(wram[status_2:status_2+2], 'little') << 16))
+    if on:
+        value |= flags
+    else:
+        value &= 0xFFFFFFFF ^ flags
+    wram[status_1:status_1+2] = (value & 0xFFFF).to_bytes(2, 'little')
+    wram[status_2:status_2+2] = (value >> 16).to_bytes(2, 'little')
+
+
+def apply_event(words):
+    event = words[0]
+    if event == 'GAIN':
+        change_item(int(words[1], 0), int(words[2]))
+    elif event == 'USE':
+        change_item(int(words[1], 0), -int(words[2]))
+    elif event == 'BATTLE':
+        set_battle(words[1] == 'START')
+    elif event == 'CHEST':
+        start, _ = get_region('CHEST_ADDRESS')
+        wram[start+int(words[1], 0)] |= int(words[2], 0)
+    elif event == 'STATUS':
+        if in_battle:
+            change_status(int(words[1]), int(words[3], 0x10),
+                          words[2] == 'ON')
+    elif event == 'GP':
+        start, end = get_region('GP_ADDRESS')
+        wram[start:end] = min(int(words[1]), 9999999).to_bytes(3, 'little')
+    else:
+        raise ValueError('Unknown event: {0}'.format(' '.join(words)))
+    stats['events'] += 1
+
+
+def load_script(filename):
+    # each line is "<seconds from start> <event>"; '#' starts a comment
+    events = []
+    f = open(filename)
+    for line in f:
+        line = line.split('#', 1)[0].split()
+        if line:
+            events.append((float(line[0]), line[1:]))
+    f.close()
+    return sorted(events, key=lambda event: event[0])
+
+
+def queue_script_events(now, loop_script):
+    global script_position, script_started
+    while script_events:
+        if script_position == len(script_events):
+            if not loop_script:
+                return
+            # start over a second after the last event
+            script_position = 0
+            script_started += script_events[-1][0] + 1
+        offset, words = script_events[script_position]
+        if script_started + offset > now:
+            return
+        pending_events.append(words)
+        script_position += 1
+
+
+def send_reply(data, address, latency, jitter):
+    stats['bytes_sent'] += len(data)
+    delay = latency + (random.random() * jitter)
+    if delay <= 0:
+        emulator_socket.sendto(data, address)
+        return
+    heapq.heappush(pending_replies,
+                   (time() + delay, stats['replies'], data, address))
+    stats['replies'] += 1
+
+
+def get_stats():
+    windows = sorted(pause_windows)
+    result = dict(stats)
+    result['pauses'] = len(windows)
+    if windows:
+        result['pause_mean'] = sum(windows) / len(windows)
+        result['pause_p90'] = windows[int(0.9 * (len(windows) - 1))]
+        result['pause_max'] = windows[-1]
+    return result
+
+
+def handle_command(data, address, latency, jitter):
+    global paused, pause_started
+    stats['bytes_received'] += len(data)
+    words = data.decode('ascii').split()
+    command = words[0]
+    stats[command] += 1
+
+    if command == 'READ_CORE_RAM':
+        start, length = int(words[1], 0x10), int(words[2])
+        offset = start - WRAM_ADDRESS
+        if offset < 0 or offset + length > WRAM_SIZE:
+            reply = 'READ_CORE_RAM {0} -1\n'.format(words[1])
+        else:
+            reply = 'READ_CORE_RAM {0} {1}\n'.format(
+                words[1], wram[offset:offset+length].hex(' ').upper())
+        send_reply(reply.encode(), address, latency, jitter)
+
+    elif command == 'WRITE_CORE_RAM':
+        offset = int(words[1], 0x10) - WRAM_ADDRESS
+        chunk = bytes(int(value, 0x10) for value in words[2:])
+        if 0 <= offset and offset + len(chunk) <= WRAM_SIZE:
+            wram[offset:offset+len(chunk)] = chunk
+        stats['writes_paused' if paused else 'writes_running'] += 1
+
+    elif command == 'FRAMEADVANCE':
+        if paused:
+            advance_frames(1)
+            stats['pause_frames'] += 1
+        else:
+            paused, pause_started = True, time()
+
+    elif command == 'PAUSE_TOGGLE':
+        if paused:
+            pause_windows.append(time() - pause_started)
+        paused, pause_started = not paused, time()
+
+    elif command == 'STATS':
+        send_reply(json.dumps(get_stats()).encode(), address, 0, 0)
+
+    elif command == 'RESET_STATS':
+        stats.clear()
+        pause_windows.clear()
+
+    elif command == 'DUMP':
+        offset = int(words[1], 0x10) - WRAM_ADDRESS
+        send_reply(wram[offset:offset+int(words[2])].hex().encode(),
+                   address, 0, 0)
+
+    else:
+        # game events can also be sent as datagrams
+        pending_events.append(words)
+
+
+def run(port, latency, jitter, loop_script):
+    global emulator_socket, script_started
+    emulator_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    emulator_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    emulator_socket.bind(('127.0.0.1', port))
+    print('Emulating RetroArch on port {0}.'.format(port))
+
+    script_started = next_frame = time()
+    while True:
+        now = time()
+        timeout = next_frame - now
+        if pending_replies:
+            timeout = min(timeout, pending_replies[0][0] - now)
+        emulator_socket.settimeout(max(timeout, 0.0001))
+        try:
+            data, address = emulator_socket.recvfrom(0x10000)
+            handle_command(data, address, latency, jitter)
+        except socket.timeout:
+            pass
+        except (ValueError, IndexError) as e:
+            print('ERROR: {0} {1}'.format(type(e), e))
+
+        now = time()
+        while pending_replies and pending_replies[0][0] <= now:
+            _, _, data, address = heapq.heappop(pending_replies)
+            emulator_socket.sendto(data, address)
+
+        if now < next_frame:
+            continue
+        frames = int((now - next_frame) / FRAME_INTERVAL) + 1
+        next_frame += frames * FRAME_INTERVAL
+        if paused:
+            continue
+
+        # the game only changes while it is running
+        advance_frames(frames)
+        queue_script_events(now, loop_script)
+        while pending_events:
+            words = pending_events.pop(0)
+            try:
+                apply_event(words)
+            except (ValueError, IndexError) as e:
+                print('ERROR: {0} {1}'.format(type(e), e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stand-in for RetroArch network commands running FF6.')
+    parser.add_argument('config', nargs='?', default='beyond_parity.cfg')
+    parser.add_argument('--port', type=int, default=55355)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before each RAM read is answered')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many more seconds, at random')
+    parser.add_argument('--script', help='file of timed game events')
+    parser.add_argument('--loop', action='store_true',
+                        help='repeat the script when it ends')
+    args = parser.parse_args()
+
+    load_addresses(args.config)
+    initialize_wram()
+    if args.script:
+        script_events.extend(load_script(args.script))
+    run(args.port, args.latency, args.jitter, args.loop)
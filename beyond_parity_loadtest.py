@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from os import path
+from time import time
+
+LATE_REPLY = 0.5
+DROPPED_REPLY = 5
+
+here = path.dirname(path.abspath(__file__))
+totals = defaultdict(int)
+latencies = []
+
+
+def encode_message(msg):
+    msg = msg.encode()
+    temp = b'!' + gzip.compress(msg)
+    if len(temp) < len(msg):
+        msg = temp
+    assert len(msg) < 4096
+    return msg
+
+
+def decode_message(msg):
+    if msg[0] == ord('!'):
+        msg = gzip.decompress(msg[1:])
+    return msg.decode('ascii').strip()
+
+
+def get_percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def get_rss(pid):
+    # resident memory in kB of a process and all of its children
+    try:
+        f = open('/proc/{0}/status'.format(pid))
+        rss = 0
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+        f.close()
+        f = open('/proc/{0}/task/{0}/children'.format(pid))
+        children = f.read().split()
+        f.close()
+    except OSError:
+        return None
+    for child in children:
+        rss += get_rss(int(child)) or 0
+    return rss
+
+
+class SimulatedClient(asyncio.DatagramProtocol):
+    def __init__(self, session_name, series_number, create, args):
+        self.session_name = session_name
+        self.series_number = series_number
+        self.create = create
+        self.args = args
+        self.transport = None
+        self.joined = asyncio.get_running_loop().create_future()
+        self.inventory = {item: random.randint(1, 10)
+                          for item in random.sample(range(0xFF), 20)}
+        self.chests = [0] * 0x40
+        self.ledger_epoch, self.ledger_version = 0, 0
+        self.message_index = 0
+        self.change_queue = []
+        self.sent_logs = []
+        self.sent_requests = {}
+
+    def send(self, msg, request=None):
+        self.transport.sendto(encode_message(msg))
+        totals['sent'] += 1
+        if request is not None:
+            self.sent_requests[request] = time()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        command = 'NEW' if self.create else 'JOIN'
+        self.send('{0} {1} {2}'.format(
+            command, self.session_name, self.series_number), 'join')
+
+    def record_reply(self, request):
+        if request not in self.sent_requests:
+            return
+        latency = time() - self.sent_requests.pop(request)
+        latencies.append(latency)
+        if latency > LATE_REPLY:
+            totals['late'] += 1
+
+    def datagram_received(self, data, sender):
+        totals['received'] += 1
+        msg = decode_message(data)
+        directive, _, payload = msg.partition(' ')
+        totals['received_' + directive.rstrip(':')] += 1
+        if msg == 'Success' or directive == 'ERROR:':
+            self.record_reply('join')
+            if not self.joined.done():
+                self.joined.set_result(msg == 'Success')
+        elif directive == 'REPORT':
+            self.send('REPORT {0} {1}'.format(
+                self.series_number, json.dumps(self.inventory)))
+        elif directive == 'DELTA':
+            self.record_reply('sync')
+            epoch, base, version, delta = json.loads(payload)
+            self.ledger_epoch, self.ledger_version = epoch, version
+        elif directive == 'LOG':
+            indexes = json.loads(payload)
+            for (i, (sent, sent_indexes)) in enumerate(self.sent_logs):
+                if sent_indexes == indexes:
+                    latency = time() - sent
+                    latencies.append(latency)
+                    if latency > LATE_REPLY:
+                        totals['late'] += 1
+                    del(self.sent_logs[i])
+                    break
+            self.change_queue = [change for change in self.change_queue
+                                 if change[0] not in indexes]
+
+    def error_received(self, exc):
+        totals['errors'] += 1
+
+    def make_changes(self, interval):
+        # each kind of change happens at its configured rate per second
+        args = self.args
+        if random.random() < args.change_rate * interval:
+            item = random.choice(list(self.inventory))
+            change = random.choice((-1, 1))
+            if self.inventory[item] + change >= 0:
+                self.inventory[item] += change
+                self.message_index += 1
+                self.change_queue.append((self.message_index, item, change))
+        if random.random() < args.status_rate * interval:
+            self.change_queue.append((
+                random.choice(('STATUS_ON', 'STATUS_OFF')),
+                random.randint(0, 3), '{0:X}'.format(1 << random.randint(
+                    0, 31))))
+        if random.random() < args.chest_rate * interval:
+            self.chests[random.randint(0, 0x3F)] |= 1 << random.randint(0, 7)
+            self.send('CHESTS {0} {1}'.format(
+                self.series_number, json.dumps(self.chests)))
+
+    def tick(self, interval):
+        now = time()
+        totals['dropped'] += len([sent for (sent, _) in self.sent_logs
+                                  if now - sent > DROPPED_REPLY])
+        self.sent_logs = [(sent, indexes) for (sent, indexes)
+                          in self.sent_logs if now - sent <= DROPPED_REPLY]
+
+        self.make_changes(interval)
+        self.send('SYNC {0} @{1}:{2}'.format(
+            self.series_number, self.ledger_epoch, self.ledger_version),
+            'sync')
+        if self.change_queue:
+            self.send('LOG {0} {1}'.format(
+                self.series_number, json.dumps(self.change_queue)))
+            self.sent_logs.append((time(), [
+                index for (index, _, _) in self.change_queue
+                if isinstance(index, int)]))
+            self.change_queue = [change for change in self.change_queue
+                                 if isinstance(change[0], int)]
+
+
+async def run_client(client, interval, stop):
+    await asyncio.sleep(random.random() * interval)
+    while not stop.done():
+        client.tick(interval)
+        await asyncio.sleep(interval)
+
+
+async def get_server_stats(address, port):
+    loop = asyncio.get_running_loop()
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    await loop.sock_connect(s, (address, port))
+    await loop.sock_sendall(s, b'STATS')
+    # a sharded server answers once per shard
+    stats = []
+    try:
+        while True:
+            data = await asyncio.wait_for(loop.sock_recv(s, 0x10000), 1)
+            stats.append(json.loads(decode_message(data).split(' ', 1)[1]))
+    except (asyncio.TimeoutError, IndexError, ValueError):
+        return stats
+    finally:
+        s.close()
+
+
+def report(elapsed, previous_totals, interval, server_pid):
+    sent = totals['sent'] - previous_totals.get('sent', 0)
+    received = totals['received'] - previous_totals.get('received', 0)
+    line = '{0:>6.0f}s: {1:.0f} sent/s, {2:.0f} received/s'.format(
+        elapsed, sent / interval, received / interval)
+    if latencies:
+        line += ', latency p50/p90/p99 {0:.1f}/{1:.1f}/{2:.1f} ms'.format(
+            *[get_percentile(latencies, f) * 1000
+              for f in (0.5, 0.9, 0.99)])
+    line += ', {0} late, {1} dropped'.format(totals['late'],
+                                              totals['dropped'])
+    if server_pid is not None:
+        rss = get_rss(server_pid)
+        if rss is not None:
+            line += ', server {0:.1f} MB'.format(rss / 1024)
+    print(line, flush=True)
+    latencies.clear()
+
+
+async def run_load(args, server_pid):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(
+            signum, lambda: stop.done() or stop.set_result(None))
+
+    series_base = random.randint(1, 1000000) * 1000
+    clients, tasks = [], []
+    for i in range(args.sessions):
+        session_name = 'load-{0}-{1}'.format(series_base, i)
+        for j in range(args.session_size):
+            client = SimulatedClient(session_name,
+                                     series_base + len(clients), j == 0, args)
+            await loop.create_datagram_endpoint(
+                lambda: client, remote_addr=(args.address, args.port))
+            if j == 0:
+                # the session has to exist before anyone joins it
+                try:
+                    await asyncio.wait_for(client.joined, DROPPED_REPLY)
+                except asyncio.TimeoutError:
+                    totals['dropped'] += 1
+            clients.append(client)
+            tasks.append(asyncio.create_task(
+                run_client(client, args.interval, stop)))
+    print('Started {0} clients in {1} sessions.'.format(
+        len(clients), args.sessions), flush=True)
+
+    started = time()
+    initial_rss = get_rss(server_pid) if server_pid is not None else None
+    previous_totals = dict(totals)
+    while not stop.done():
+        await asyncio.wait([stop], timeout=args.report_interval)
+        elapsed = time() - started
+        report(elapsed, previous_totals, args.report_interval, server_pid)
+        previous_totals = dict(totals)
+        if args.duration and elapsed >= args.duration:
+            stop.done() or stop.set_result(None)
+
+    await asyncio.gather(*tasks)
+    print('Totals: {0}'.format(json.dumps(dict(sorted(totals.items())))))
+    if initial_rss is not None:
+        rss = get_rss(server_pid)
+        if rss is not None:
+            print('Server memory grew {0:.1f} MB to {1:.1f} MB.'.format(
+                (rss - initial_rss) / 1024, rss / 1024))
+    pending = defaultdict(int)
+    for stats in await get_server_stats(args.address, args.port):
+        for (key, value) in stats['pending'].items():
+            pending[key] += value
+    if pending:
+        print('Server pending: {0}'.format(json.dumps(pending)))
+    for client in clients:
+        client.transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate many clients against a sync server.')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55433)
+    parser.add_argument('--start-server', action='store_true',
+                        help='run a fresh local server for the test')
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--server-pid', type=int,
+                        help='measure the memory of a running server')
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--session-size', type=int, default=4)
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between each client\'s syncs')
+    parser.add_argument('--change-rate', type=float, default=0.2,
+                        help='item changes per client per second')
+    parser.add_argument('--status-rate', type=float, default=0.05)
+    parser.add_argument('--chest-rate', type=float, default=0.01)
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to run, or 0 to run until stopped')
+    parser.add_argument('--report-interval', type=float, default=10)
+    args = parser.parse_args()
+
+    server, server_pid = None, args.server_pid
+    if args.start_server:
+        directory = tempfile.mkdtemp(prefix='beyond_parity_loadtest_')
+        log_file = open(path.join(directory, 'server.log'), 'w')
+        server = subprocess.Popen(
+            [sys.executable, path.join(here, 'beyond_parity_server.py'),
+             '--address', args.address, '--port', str(args.port),
+             '--shards', str(args.shards)],
+            stdout=log_file, stderr=subprocess.STDOUT, cwd=directory)
+        log_file.close()
+        server_pid = server.pid
+        print('Server state and log are in {0}'.format(directory))
+        asyncio.run(asyncio.sleep(1))
+
+    try:
+        asyncio.run(run_load(args, server_pid))
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
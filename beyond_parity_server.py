@@ -1,30 +1,97 @@
+import argparse
+import asyncio
 import gzip
 import json
+import multiprocessing
+import random
+import signal
 import socket
+import struct
+import time
+import zlib
+from array import array
+from bisect import bisect
 from collections import defaultdict
-from datetime import datetime
-from os import listdir
+from concurrent.futures import ThreadPoolExecutor
+from os import fsync, listdir, remove, replace
 from sys import exc_info
-from time import time, sleep
 
-POLL_INTERVAL = 0.5
 SERVER_IP = '10.0.0.111'
 SERVER_PORT = 55333
-LOG_RETENTION_DURATION = 599
+LOG_WINDOW_SIZE = 256
+SUBSCRIPTION_TIMEOUT = 60
+RETRANSMIT_INTERVAL = 3
+MAX_PUSH_BACKLOG = 64
+MAX_DATAGRAM_SIZE = 4096
+FRAGMENT_SIZE = 4000
+MAX_FRAGMENTS = 64
+FRAGMENT_TIMEOUT = 5
+STATUS_TIMEOUT = 30
+BATTLE_CHARACTERS = 4
+JOURNAL_FLUSH_INTERVAL = 1
 BACKUP_INTERVAL = 899
+BACKUP_RETENTION = 4
+METRICS_INTERVAL = 300
+LATENCY_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1)
+REQUEST_COMMANDS = ('NEW', 'JOIN', 'REPORT', 'LOG', 'SYNC', 'CHESTS', 'STATS',
+                    'SUBSCRIBE', 'ACK')
+ADMIN_ADDRESSES = ('127.0.0.1', '::1')
+PACKET_MAGIC = 0xB1
+PACKET_HEADER = struct.Struct('>BBII')
+PACKET_DIRECTIVES = ('Success', 'ERROR', 'REPORT', 'LOG', 'SYNC', 'SUBSCRIBE',
+                     'SUBSCRIBED', 'DELTA', 'CHESTS', 'STATUS_ON',
+                     'STATUS_OFF', 'ACK', 'BATCH', 'FRAGMENT', 'STATUS',
+                     'CHEST_DELTA')
+BATCH_ENTRY = struct.Struct('>H')
+FRAGMENT_ENTRY = struct.Struct('>HH')
+INVENTORY_ENTRY = struct.Struct('>Bh')
+LOG_ENTRY = struct.Struct('>IBh')
+STATUS_ENTRY = struct.Struct('>BBI')
+STATUS_MASKS = struct.Struct('>BII')
+CHEST_ENTRY = struct.Struct('>BB')
+BINARY_OFFER = 'B1'
+SNAPSHOT_FORMAT = '{0}snapshot_{1:0>12}.json'
+JOURNAL_FORMAT = '{0}journal_{1:0>12}.jsonl'
 
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-server_socket.bind((SERVER_IP, SERVER_PORT))
-server_socket.settimeout(POLL_INTERVAL)
-
+server_transport = None
+router_connection = None
+reply_batches = None
+fragments = {}
+fragment_sequence = 0
+state_prefix = 'parity_'
+journal_executor = ThreadPoolExecutor(max_workers=1)
+journal_buffer = []
+journal_filename = JOURNAL_FORMAT.format(state_prefix, 0)
+journal_sequence = 0
+snapshot_sequence = 0
 
 members = {}
+session_members = defaultdict(set)
 item_ledger = {}
-processed_logs = {}
+ledger_epochs = {}
+ledger_versions = {}
+item_versions = {}
 session_chests = {}
+chest_versions = {}
+chest_byte_versions = {}
 session_changes = defaultdict(set)
-session_status_changes = defaultdict(set)
+session_status_changes = defaultdict(dict)
 session_chest_changes = defaultdict(set)
+dormant_sessions = {}
+dormant_members = {}
+resync_sessions = set()
+push_members = set()
+member_shards = {}
+pending_routes = {}
+
+metrics_started = time.time()
+request_counts = defaultdict(int)
+request_bytes = defaultdict(int)
+request_latencies = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+reply_counts = defaultdict(int)
+reply_bytes = defaultdict(int)
+datagram_counts = defaultdict(int)
+gzip_totals = defaultdict(int)
 
 
 def convert_dict_keys_to_int(mydict):
@@ -42,225 +109,1377 @@ def convert_dict_keys_to_int(mydict):
     return temp
 
 
-def client_send(msg, client):
+class Member:
+    __slots__ = ('name', 'session_name', 'address', 'log_watermark',
+                 'log_window', 'ledger_epoch', 'ledger_version',
+                 'chest_version', 'subscribed_until', 'push_sequence',
+                 'outbox', 'binary')
+
+    def __init__(self, name, session_name, address=None):
+        self.name = name
+        self.session_name = session_name
+        self.address = address
+        self.log_watermark = 0
+        self.log_window = set()
+        self.ledger_epoch = 0
+        self.ledger_version = 0
+        self.chest_version = 0
+        self.subscribed_until = 0
+        self.push_sequence = 0
+        self.outbox = {}
+        self.binary = False
+
+    @property
+    def subscribed(self):
+        return self.subscribed_until > time.time()
+
+    def accepts_log(self, index):
+        # Indexes too far past the watermark are left unacked, so the
+        # client resends them once the gap below has filled in.
+        return index <= self.log_watermark + LOG_WINDOW_SIZE
+
+    def mark_log(self, index):
+        # Every index up to the watermark has been applied. Indexes past
+        # it are remembered until the gap below them fills in. Only legacy
+        # backups can overflow the window, which pushes the watermark past
+        # the gap.
+        if index <= self.log_watermark or index in self.log_window:
+            return False
+
+        self.log_window.add(index)
+        if len(self.log_window) > LOG_WINDOW_SIZE:
+            self.log_watermark = min(self.log_window)
+            self.log_window.remove(self.log_watermark)
+        while self.log_watermark + 1 in self.log_window:
+            self.log_watermark += 1
+            self.log_window.remove(self.log_watermark)
+        return True
+
+
+def add_member(member_name, session_name, address=None):
+    if member_name in dormant_members:
+        wake_session(dormant_members[member_name])
+    if member_name in members:
+        remove_member(member_name)
+    member = Member(member_name, session_name, address)
+    members[member_name] = member
+    session_members[session_name].add(member_name)
+    return member
+
+
+def remove_member(member_name):
+    member = members.pop(member_name)
+    roster = session_members[member.session_name]
+    roster.discard(member_name)
+    if not roster:
+        del(session_members[member.session_name])
+
+
+def get_member(sender, series_number):
+    member_name = '{0}-{1}'.format(sender[0], series_number)
+    if member_name in dormant_members:
+        wake_session(dormant_members[member_name])
+    member = members[member_name]
+    member.address = sender
+    return member
+
+
+def announce_member(member_name):
+    # A shard tells the router how every NEW or JOIN it handled turned
+    # out. The router holds the member's other requests until then.
+    if router_connection is not None:
+        if member_name in members:
+            router_connection.send(('JOINED', member_name))
+        else:
+            router_connection.send(('REJECTED', member_name))
+
+
+def leave_shard(member_name):
+    # the member joined a session owned by another shard
+    if member_name in dormant_members:
+        wake_session(dormant_members[member_name])
+    if member_name in members:
+        remove_member(member_name)
+
+
+def new_ledger_epoch():
+    return random.getrandbits(31) + 1
+
+
+def load_ledger_array(values, typecode):
+    # snapshots store all 256 values as a list; older ones used a dict
+    if not isinstance(values, dict):
+        return array(typecode, values)
+    my_array = array(typecode, [0]) * 0x100
+    for (key, value) in values.items():
+        my_array[int(key)] = value
+    return my_array
+
+
+def bump_ledger_version(session_name, items):
+    version = ledger_versions[session_name] + 1
+    ledger_versions[session_name] = version
+    for item in items:
+        item_versions[session_name][item] = version
+
+
+def get_session_inventory(session_name):
+    return {key: amount for (key, amount)
+            in enumerate(item_ledger[session_name]) if amount > 0}
+
+
+def get_ledger_delta(session_name, epoch, base):
+    my_ledger = item_ledger[session_name]
+    version = ledger_versions[session_name]
+    session_inventory = get_session_inventory(session_name)
+    if epoch == ledger_epochs[session_name] and 0 < base <= version:
+        my_versions = item_versions[session_name]
+        delta = {key: my_ledger[key] for key in range(0x100)
+                 if my_versions[key] > base}
+        if len(delta) <= len(session_inventory):
+            return base, version, delta
+    return 0, version, session_inventory
+
+
+def initialize_chests(session_name, chests):
+    # Chest versions are not saved, so they start from a random number;
+    # a version a client kept from before a restart then asks for
+    # everything again instead of matching a different state.
+    version = new_ledger_epoch()
+    session_chests[session_name] = bytearray(chests)
+    chest_versions[session_name] = version
+    chest_byte_versions[session_name] = array('I', [version]) * 0x40
+
+
+def get_chest_delta(session_name, base):
+    my_chests = session_chests[session_name]
+    version = chest_versions[session_name]
+    if 0 < base <= version:
+        my_versions = chest_byte_versions[session_name]
+        delta = {i: my_chests[i] for i in range(0x40)
+                 if my_versions[i] > base}
+        return [base, version, delta]
+    return [0, version, {i: my_chests[i] for i in range(0x40)
+                         if my_chests[i]}]
+
+
+def push(member, kind, directive, parameters):
+    # DELTA and CHESTS carry everything since the member's acknowledged
+    # version, so a newer one replaces any that has not been acknowledged
+    if kind != 'STATUS':
+        for sequence in [sequence for sequence in member.outbox
+                         if member.outbox[sequence][0] == kind]:
+            del(member.outbox[sequence])
+    if len(member.outbox) >= MAX_PUSH_BACKLOG:
+        del(member.outbox[min(member.outbox)])
+
+    member.push_sequence += 1
+    data = send_directive(directive, parameters, member.address,
+                          member.binary, member.push_sequence)
+    member.outbox[member.push_sequence] = [kind, data, time.time()]
+    push_members.add(member.name)
+
+
+def push_ledger(member):
+    session_name = member.session_name
+    base, version, delta = get_ledger_delta(
+        session_name, member.ledger_epoch, member.ledger_version)
+    push(member, 'DELTA', 'DELTA',
+         [ledger_epochs[session_name], base, version, delta])
+
+
+def retransmit_pushes():
+    begin_replies()
+    try:
+        resend_pushes()
+    finally:
+        flush_replies()
+
+
+def resend_pushes():
+    now = time.time()
+    for member_name in list(push_members):
+        member = members.get(member_name)
+        if member is not None and not member.subscribed:
+            # a lapsed subscriber goes back to polling with SYNC
+            member.outbox.clear()
+        if member is None or not member.outbox:
+            push_members.discard(member_name)
+            continue
+        for entry in member.outbox.values():
+            if now - entry[2] >= RETRANSMIT_INTERVAL:
+                send_packet(entry[1], member.address, member.binary)
+                record_reply('RETRANSMIT', len(entry[1]), len(entry[1]))
+                entry[2] = now
+
+
+def fold_status_change(status_changes, command, character, mask):
+    # Only the net effect of a character's status changes is kept, as
+    # [flags set, flags cleared, time of the last change].
+    mask &= 0xFFFFFFFF
+    if not mask:
+        return
+    set_mask, clear_mask, _ = status_changes.get(character, (0, 0, 0))
+    if command == 'STATUS_ON':
+        set_mask, clear_mask = set_mask | mask, clear_mask & ~mask
+    else:
+        set_mask, clear_mask = set_mask & ~mask, clear_mask | mask
+    status_changes[character] = [set_mask, clear_mask, time.time()]
+
+
+def merge_status_changes(pending, status_changes):
+    for (character, (set_mask, clear_mask, _)) in status_changes.items():
+        fold_status_change(pending, 'STATUS_ON', character, set_mask)
+        fold_status_change(pending, 'STATUS_OFF', character, clear_mask)
+
+
+def get_status_directives(status_changes, binary):
+    # binary clients get every character in one STATUS message; text
+    # clients get at most one STATUS_ON and one STATUS_OFF per character
+    if not status_changes:
+        return []
+    if binary:
+        return [('STATUS', [[character, set_mask, clear_mask]
+                            for (character, (set_mask, clear_mask, _))
+                            in sorted(status_changes.items())])]
+    directives = []
+    for (character, (set_mask, clear_mask, _)) in sorted(
+            status_changes.items()):
+        if clear_mask:
+            directives.append(('STATUS_OFF',
+                               [character, '{0:X}'.format(clear_mask)]))
+        if set_mask:
+            directives.append(('STATUS_ON',
+                               [character, '{0:X}'.format(set_mask)]))
+    return directives
+
+
+def expire_status_changes():
+    # statuses from a battle the member never came back to see are stale
+    now = time.time()
+    for member_name in list(session_status_changes):
+        status_changes = session_status_changes[member_name]
+        for character in [character for character in status_changes
+                          if now - status_changes[character][2]
+                          > STATUS_TIMEOUT]:
+            del(status_changes[character])
+        if not status_changes:
+            del(session_status_changes[member_name])
+
+
+def wake_session(session_name):
+    # Sessions restored from a snapshot stay in their serialized form
+    # until a member or a journal entry touches them.
+    if session_name not in dormant_sessions:
+        return
+
+    ledger, chests, state_members = dormant_sessions.pop(session_name)
+    initialize_chests(session_name, chests)
+    if ledger is None:
+        item_ledger[session_name] = None
+    else:
+        epoch, version, my_ledger, my_versions = ledger
+        item_ledger[session_name] = load_ledger_array(my_ledger, 'i')
+        ledger_epochs[session_name] = epoch
+        ledger_versions[session_name] = version
+        item_versions[session_name] = load_ledger_array(my_versions, 'I')
+
+    for (m, (_, log_watermark, log_window)) in state_members.items():
+        del(dormant_members[m])
+        member = add_member(m, session_name)
+        member.log_watermark = log_watermark
+        member.log_window = set(log_window)
+
+    if session_name in resync_sessions:
+        resync_sessions.remove(session_name)
+        session_changes[session_name] |= session_members[session_name]
+
+
+def session_exists(session_name):
+    return session_name in item_ledger or session_name in dormant_sessions
+
+
+def create_session(session_name):
+    item_ledger[session_name] = None
+    initialize_chests(session_name, bytes(0x40))
+
+
+def initialize_ledger(session_name, inventory, epoch):
+    item_ledger[session_name] = load_ledger_array(inventory, 'i')
+    ledger_epochs[session_name] = epoch
+    ledger_versions[session_name] = 0
+    item_versions[session_name] = array('I', [0]) * 0x100
+    bump_ledger_version(session_name, range(0x100))
+
+
+def apply_item_changes(member, changes):
+    applied = []
+    for (index, item, change) in changes:
+        assert 0 <= item < 0x100
+        if not member.mark_log(index):
+            continue
+        item_ledger[member.session_name][item] += change
+        applied.append((index, item, change))
+
+    if applied:
+        bump_ledger_version(member.session_name,
+                            {item for (_, item, _) in applied})
+    return applied
+
+
+def merge_chests(session_name, chests):
+    # chests maps chest bytes to the bits that were set in them; returns
+    # whether any of them were new
+    my_chests = session_chests[session_name]
+    changed = [i for (i, bits) in chests.items()
+               if bits | my_chests[i] != my_chests[i]]
+    if not changed:
+        return False
+    version = chest_versions[session_name] + 1
+    chest_versions[session_name] = version
+    for i in changed:
+        my_chests[i] |= chests[i]
+        chest_byte_versions[session_name][i] = version
+    return True
+
+
+def journal(*record):
+    global journal_sequence
+    journal_sequence += 1
+    journal_buffer.append(json.dumps([journal_sequence] + list(record)))
+
+
+def apply_journal_record(command, *parameters):
+    if command == 'NEW':
+        member_name, session_name = parameters
+        create_session(session_name)
+        add_member(member_name, session_name)
+    elif command == 'JOIN':
+        member_name, session_name = parameters
+        wake_session(session_name)
+        add_member(member_name, session_name)
+    elif command == 'REPORT':
+        session_name, epoch, inventory = parameters
+        wake_session(session_name)
+        initialize_ledger(session_name, convert_dict_keys_to_int(inventory),
+                          epoch)
+    elif command == 'LOG':
+        member_name, changes = parameters
+        if member_name in dormant_members:
+            wake_session(dormant_members[member_name])
+        apply_item_changes(members[member_name], changes)
+    elif command == 'CHESTS':
+        session_name, chests = parameters
+        wake_session(session_name)
+        merge_chests(session_name, dict(enumerate(chests)))
+    elif command == 'LEAVE':
+        member_name, = parameters
+        leave_shard(member_name)
+
+
+def record_request(command, raw_size, wire_size, elapsed):
+    if command not in REQUEST_COMMANDS:
+        command = 'OTHER'
+    request_counts[command] += 1
+    request_bytes[command] += wire_size
+    request_latencies[command][bisect(LATENCY_BUCKETS, elapsed)] += 1
+    gzip_totals['in_raw'] += raw_size
+    gzip_totals['in_wire'] += wire_size
+
+
+def record_reply(command, raw_size, wire_size):
+    command = command.rstrip(':')
+    reply_counts[command] += 1
+    reply_bytes[command] += wire_size
+    gzip_totals['out_raw'] += raw_size
+    gzip_totals['out_wire'] += wire_size
+
+
+def get_metrics():
+    pending = {
+        'changes': sum(len(v) for v in session_changes.values()),
+        'status_changes': sum(len(v) for v in
+                              session_status_changes.values()),
+        'chest_changes': sum(len(v) for v in session_chest_changes.values()),
+        'journal': len(journal_buffer),
+        'pushes': sum(len(members[m].outbox) for m in push_members
+                      if m in members),
+        }
+    return {
+        'state': state_prefix,
+        'uptime': round(time.time() - metrics_started),
+        'requests': {c: [request_counts[c], request_bytes[c]]
+                     for c in request_counts},
+        'latency_buckets': LATENCY_BUCKETS,
+        'latencies': dict(request_latencies),
+        'replies': {c: [reply_counts[c], reply_bytes[c]]
+                    for c in reply_counts},
+        'gzip': dict(gzip_totals),
+        'datagrams': dict(datagram_counts),
+        'pending': pending,
+        'log_windows': sum(len(m.log_window) for m in members.values()),
+        'members': len(members) + len(dormant_members),
+        'sessions': len(item_ledger),
+        'dormant_sessions': len(dormant_sessions),
+        }
+
+
+def print_metrics():
+    print('STATS {0}'.format(json.dumps(get_metrics())))
+
+
+def encode_text(msg):
     msg = msg.encode()
     temp = b'!' + gzip.compress(msg)
     if len(temp) < len(msg):
         msg = temp
     assert len(msg) < 4096
-    server_socket.sendto(msg, client)
+    return msg
+
+
+def send_packet(data, client, batch=False):
+    # binary packets to the same client are held until the request is
+    # handled and then sent together in BATCH envelopes
+    if batch and reply_batches is not None:
+        reply_batches[client].append(data)
+        return
+    if batch and len(data) >= MAX_DATAGRAM_SIZE:
+        for fragment in encode_fragments(data):
+            server_transport.sendto(fragment, client)
+            datagram_counts['sent'] += 1
+        return
+    assert len(data) < MAX_DATAGRAM_SIZE
+    server_transport.sendto(data, client)
+    datagram_counts['sent'] += 1
+
+
+def encode_fragments(data):
+    global fragment_sequence
+    fragment_sequence = (fragment_sequence + 1) & 0xFFFFFFFF
+    opcode = PACKET_DIRECTIVES.index('FRAGMENT') + 1
+    count = (len(data) + FRAGMENT_SIZE - 1) // FRAGMENT_SIZE
+    if count > MAX_FRAGMENTS:
+        raise ValueError('{0} byte packet is too large.'.format(len(data)))
+    for index in range(count):
+        yield (PACKET_HEADER.pack(PACKET_MAGIC, opcode, 0, fragment_sequence)
+               + FRAGMENT_ENTRY.pack(index, count)
+               + data[index*FRAGMENT_SIZE:(index+1)*FRAGMENT_SIZE])
 
 
-def client_receive():
-    msg, client = server_socket.recvfrom(4096)
+def reassemble(data, sender):
+    # returns the whole packet once all of its fragments have arrived;
+    # fragments of packets that never complete are dropped after a while
+    now = time.time()
+    for key in [key for key in fragments
+                if now - fragments[key][0] > FRAGMENT_TIMEOUT]:
+        del(fragments[key])
+
+    _, _, _, sequence = PACKET_HEADER.unpack_from(data)
+    index, count = FRAGMENT_ENTRY.unpack_from(data, PACKET_HEADER.size)
+    if not index < count <= MAX_FRAGMENTS:
+        raise ValueError('Bad fragment {0} of {1}.'.format(index, count))
+    key = (sender, sequence)
+    if key not in fragments:
+        fragments[key] = [now, {}]
+    pieces = fragments[key][1]
+    pieces[index] = data[PACKET_HEADER.size+FRAGMENT_ENTRY.size:]
+    if len(pieces) < count:
+        return None
+    del(fragments[key])
+    return b''.join(pieces[i] for i in range(count))
+
+
+def encode_batches(packets):
+    envelopes = [[]]
+    size = PACKET_HEADER.size
+    for data in packets:
+        if (envelopes[-1] and size + BATCH_ENTRY.size + len(data)
+                >= MAX_DATAGRAM_SIZE):
+            envelopes.append([])
+            size = PACKET_HEADER.size
+        envelopes[-1].append(data)
+        size += BATCH_ENTRY.size + len(data)
+
+    opcode = PACKET_DIRECTIVES.index('BATCH') + 1
+    for envelope in envelopes:
+        if len(envelope) == 1:
+            yield envelope[0]
+        elif envelope:
+            yield PACKET_HEADER.pack(PACKET_MAGIC, opcode, 0, 0) + b''.join(
+                BATCH_ENTRY.pack(len(data)) + data for data in envelope)
+
+
+def split_batch(data):
+    if data[1] != PACKET_DIRECTIVES.index('BATCH') + 1:
+        return [data]
+    packets = []
+    offset = PACKET_HEADER.size
+    while offset < len(data):
+        length, = BATCH_ENTRY.unpack_from(data, offset)
+        offset += BATCH_ENTRY.size
+        packets.append(data[offset:offset+length])
+        offset += length
+    return packets
+
+
+def begin_replies():
+    global reply_batches
+    if reply_batches is None:
+        reply_batches = defaultdict(list)
+
+
+def flush_replies():
+    global reply_batches
+    batches, reply_batches = reply_batches, None
+    for (client, packets) in batches.items():
+        for data in encode_batches(packets):
+            send_packet(data, client, batch=True)
+
+
+def client_send(msg, client):
+    data = encode_text(msg)
+    send_packet(data, client)
+    record_reply(msg.split(' ', 1)[0], len(msg), len(data))
+
+
+def client_receive(msg):
     if msg[0] == ord('!'):
         msg = gzip.decompress(msg[1:])
     msg = msg.decode('ascii').strip()
-    return msg, client
+    return msg
+
+
+def pack_inventory(inventory):
+    return b''.join(INVENTORY_ENTRY.pack(item, amount)
+                    for (item, amount) in inventory.items())
+
+
+def encode_packet(directive, parameters, sequence=0):
+    if directive == 'ERROR':
+        payload = parameters.encode()
+    elif directive == 'LOG':
+        payload = struct.pack('>{0}I'.format(len(parameters)), *parameters)
+    elif directive == 'DELTA':
+        epoch, base, version, delta = parameters
+        payload = (struct.pack('>III', epoch, base, version)
+                   + pack_inventory(delta))
+    elif directive == 'SUBSCRIBED':
+        payload = struct.pack('>HI', *parameters)
+    elif directive == 'CHESTS':
+        payload = bytes(parameters)
+    elif directive == 'CHEST_DELTA':
+        base, version, delta = parameters
+        payload = struct.pack('>II', base, version) + b''.join(
+            CHEST_ENTRY.pack(i, bits) for (i, bits) in delta.items())
+    elif directive in ('STATUS_ON', 'STATUS_OFF'):
+        character, change = parameters
+        payload = struct.pack('>BI', character, int(change, 0x10))
+    elif directive == 'STATUS':
+        payload = b''.join(STATUS_MASKS.pack(*masks) for masks in parameters)
+    else:
+        payload = b''
+    opcode = PACKET_DIRECTIVES.index(directive) + 1
+    return PACKET_HEADER.pack(PACKET_MAGIC, opcode, 0, sequence) + payload
+
+
+def decode_packet(data):
+    # returns a request in the same form as parse_text_request
+    _, opcode, series_number, sequence = PACKET_HEADER.unpack_from(data)
+    command = PACKET_DIRECTIVES[opcode - 1]
+    payload = data[PACKET_HEADER.size:]
+    if command == 'REPORT':
+        arguments = dict(INVENTORY_ENTRY.iter_unpack(payload))
+    elif command == 'LOG':
+        count, = struct.unpack_from('>H', payload)
+        end = 2 + (count * LOG_ENTRY.size)
+        arguments = [list(entry) for entry in
+                     LOG_ENTRY.iter_unpack(payload[2:end])]
+        for (on, character, mask) in STATUS_ENTRY.iter_unpack(payload[end:]):
+            arguments.append(['STATUS_ON' if on else 'STATUS_OFF',
+                              character, '{0:X}'.format(mask)])
+    elif command in ('SYNC', 'SUBSCRIBE'):
+        epoch, version, chest_version = struct.unpack('>III', payload)
+        arguments = (epoch, version, False, chest_version)
+    elif command == 'CHESTS':
+        arguments = dict(CHEST_ENTRY.iter_unpack(payload))
+    elif command == 'ACK':
+        arguments = (sequence,) + struct.unpack('>III', payload)
+    else:
+        raise ValueError('Unexpected {0} packet.'.format(command))
+    return command, str(series_number), arguments
+
+
+def parse_text_request(msg):
+    command, _, arguments = msg.partition(' ')
+    if command in ('NEW', 'JOIN'):
+        session_name, series_number, *offer = arguments.split(' ')
+        return command, series_number, (session_name,
+                                         offer == [BINARY_OFFER])
+    if command in ('SYNC', 'SUBSCRIBE'):
+        series_number, _, option = arguments.partition(' ')
+        if option.startswith('@'):
+            option, _, force = option.partition(' ')
+            epoch, version = map(int, option[1:].split(':'))
+            if force == '!':
+                # a forced sync wants the whole ledger
+                epoch, version = 0, 0
+            return command, series_number, (epoch, version, force == '!',
+                                            None)
+        return command, series_number, (None, None, option == '!', None)
+    if command == 'ACK':
+        series_number, sequence, option = arguments.split(' ')
+        epoch, version = map(int, option[1:].split(':'))
+        return command, series_number, (int(sequence), epoch, version,
+                                        None)
+    if command in ('REPORT', 'LOG', 'CHESTS'):
+        series_number, payload = arguments.split(' ', 1)
+        return command, series_number, convert_dict_keys_to_int(
+            json.loads(payload))
+    return command, None, None
+
+
+def send_directive(directive, parameters, client, binary=False,
+                   sequence=0):
+    if binary:
+        data = encode_packet(directive, parameters, sequence)
+        raw_size = len(data)
+    else:
+        msg = directive
+        if parameters is not None:
+            msg = '{0} {1}'.format(directive, json.dumps(parameters))
+        if sequence:
+            msg = 'PUSH {0} {1}'.format(sequence, msg)
+        data = encode_text(msg)
+        raw_size = len(msg)
+    send_packet(data, client, batch=binary)
+    record_reply(directive, raw_size, len(data))
+    return data
+
+
+def send_error(error_msg, client, binary=False):
+    print('ERROR: {0}'.format(error_msg))
+    if binary:
+        send_directive('ERROR', error_msg, client, binary)
+    else:
+        client_send('ERROR: {0}'.format(error_msg), client)
+
 
+def handle_datagram(data, sender):
+    datagram_counts['received'] += 1
+    if data[0] == PACKET_MAGIC:
+        if data[1] == PACKET_DIRECTIVES.index('FRAGMENT') + 1:
+            data = reassemble(data, sender)
+            if data is None:
+                return
+        for packet in split_batch(data):
+            handle_packet(packet, sender)
+        return
 
-def main_loop():
-    timestamp = int(round(time()))
-    msg, sender, sender_address, sender_port = None, None, None, None
-    session_name, series_number, member_name = None, None, None
-    session_members = None
     try:
-        msg, sender = client_receive()
-        sender_address, sender_port = sender
-        print(msg, sender)
-
-        if msg.startswith('NEW '):
-            _, session_name, series_number = msg.split(' ')
-            if session_name in item_ledger:
-                reply = 'ERROR: Session "{0}" already exists.'.format(
-                    session_name)
+        msg = client_receive(data)
+    except:
+        send_error('{0} {1}'.format(exc_info()[0], exc_info()[1]), sender)
+        return
+    handle_message(msg, sender, len(data))
+
+
+def handle_packet(data, sender):
+    started = time.perf_counter()
+    try:
+        command, series_number, arguments = decode_packet(data)
+    except:
+        send_error('{0} {1}'.format(exc_info()[0], exc_info()[1]), sender,
+                   binary=True)
+        return
+    print(command, series_number, arguments, sender)
+    handle_request(command, series_number, arguments, sender, binary=True)
+    record_request(command, len(data), len(data),
+                   time.perf_counter() - started)
+
+
+def handle_message(msg, sender, wire_size):
+    started = time.perf_counter()
+    print(msg, sender)
+    try:
+        command, series_number, arguments = parse_text_request(msg)
+    except:
+        command = None
+        send_error('{0} {1}'.format(exc_info()[0], exc_info()[1]), sender)
+    else:
+        handle_request(command, series_number, arguments, sender)
+        if command in ('NEW', 'JOIN'):
+            announce_member('{0}-{1}'.format(sender[0], series_number))
+    record_request(command, len(msg), wire_size,
+                   time.perf_counter() - started)
+
+
+def handle_request(command, series_number, arguments, sender, binary=False):
+    sender_address, sender_port = sender[:2]
+    session_name, member_name = None, None
+    recipients = None
+    try:
+        if command in ('NEW', 'JOIN'):
+            session_name, binary = arguments
+        elif series_number is not None:
+            member = get_member(sender, series_number)
+            member_name, session_name = member.name, member.session_name
+            member.binary = binary
+
+        if command == 'STATS':
+            # the host itself can reach the server at its bind address
+            if (sender_address in ADMIN_ADDRESSES
+                    or sender_address == SERVER_IP):
+                reply = 'STATS {0}'.format(json.dumps(get_metrics()))
                 client_send(reply, sender)
+            else:
+                send_error('STATS is only available locally.', sender)
+
+        elif command == 'NEW':
+            if session_exists(session_name):
+                send_error('Session "{0}" already exists.'.format(
+                    session_name), sender, binary)
             else:
                 member_name = '{0}-{1}'.format(sender_address, series_number)
-                members[member_name] = session_name
+                create_session(session_name)
+                member = add_member(member_name, session_name, sender)
+                member.binary = binary
+                journal('NEW', member_name, session_name)
                 session_changes[session_name].add(member_name)
-                item_ledger[session_name] = None
-                session_chests[session_name] = [0] * 0x40
 
-                reply = 'Success'.format(
-                    session_name)
-                client_send(reply, sender)
-                client_send('REPORT {}', sender)
+                send_directive('Success', None, sender, binary)
+                send_directive('REPORT', {}, sender, binary)
 
-        elif msg.startswith('JOIN '):
-            _, session_name, series_number = msg.split(' ')
+        elif command == 'JOIN':
+            wake_session(session_name)
             if session_name not in item_ledger:
-                reply = 'ERROR: Session "{0}" does not exist.'.format(
-                    session_name)
-                client_send(reply, sender)
+                send_error('Session "{0}" does not exist.'.format(
+                    session_name), sender, binary)
             else:
                 member_name = '{0}-{1}'.format(sender_address, series_number)
-                members[member_name] = session_name
+                member = add_member(member_name, session_name, sender)
+                member.binary = binary
+                journal('JOIN', member_name, session_name)
                 session_changes[session_name].add(member_name)
 
-                reply = 'Success'.format(
-                    session_name)
-                client_send(reply, sender)
-
-        elif msg.startswith('REPORT '):
-            _, series_number, payload = msg.split(' ', 2)
-            member_name = '{0}-{1}'.format(sender_address, series_number)
-            session_name = members[member_name]
+                send_directive('Success', None, sender, binary)
 
+        elif command == 'REPORT':
             if (session_name in item_ledger
                     and item_ledger[session_name] is None):
-                session_name = members[member_name]
-                session_members = {m for m in members
-                                   if members[m] == session_name}
-                session_changes[session_name] |= session_members
-
-                item_ledger[session_name] = {}
-                current_inventory = convert_dict_keys_to_int(
-                    json.loads(payload))
-                for i in range(0x100):
-                    if i in current_inventory:
-                        item_ledger[session_name][i] = current_inventory[i]
-                    else:
-                        item_ledger[session_name][i] = 0
-
-        elif msg.startswith('LOG '):
-            _, series_number, payload = msg.split(' ', 2)
-            member_name = '{0}-{1}'.format(sender_address, series_number)
-            session_name = members[member_name]
-            session_members = {m for m in members
-                               if members[m] == session_name
-                               and m != member_name}
-            session_changes[session_name] |= session_members
-
-            change_queue = json.loads(payload)
+                session_changes[session_name] |= session_members[
+                    session_name]
+
+                current_inventory = arguments
+                epoch = new_ledger_epoch()
+                initialize_ledger(session_name, current_inventory, epoch)
+                journal('REPORT', session_name, epoch, current_inventory)
+                for m in session_members[session_name]:
+                    if members[m].subscribed:
+                        push_ledger(members[m])
+
+        elif command == 'LOG':
+            recipients = session_members[session_name] - {member_name}
+            session_changes[session_name] |= recipients
+
+            change_queue = arguments
             done_indexes = []
+            item_changes = []
+            status_changes = {}
             for (index, item, change) in change_queue:
                 if isinstance(index, str) and index.startswith('STATUS_'):
-                    for m in session_members:
-                        session_status_changes[m].add(
-                            (index.upper(), item, change))
+                    if item in range(BATTLE_CHARACTERS):
+                        fold_status_change(status_changes, index.upper(),
+                                           item, int(change, 0x10))
                     continue
 
-                done_indexes.append(index)
-                log_identifier = '{0}-{1}'.format(member_name, index)
-                if log_identifier in processed_logs:
+                if not member.accepts_log(index):
                     continue
+                done_indexes.append(index)
+                item_changes.append((index, item, change))
 
-                processed_logs[log_identifier] = timestamp
-                item_ledger[session_name][item] += change
+            for m in recipients:
+                if members[m].subscribed:
+                    for (directive, parameters) in get_status_directives(
+                            status_changes, members[m].binary):
+                        push(members[m], 'STATUS', directive, parameters)
+                elif status_changes:
+                    merge_status_changes(session_status_changes[m],
+                                         status_changes)
 
-            reply = 'LOG {0}'.format(json.dumps(done_indexes))
-            client_send(reply, sender)
+            applied = apply_item_changes(member, item_changes)
+            if applied:
+                journal('LOG', member_name, applied)
+                for m in recipients:
+                    if members[m].subscribed:
+                        push_ledger(members[m])
 
-        elif msg.startswith('SYNC '):
-            try:
-                _, series_number, option = msg.split(' ', 2)
-                force_sync = option == '!'
-            except:
-                _, series_number = msg.split(' ', 1)
-                force_sync = False
-            member_name = '{0}-{1}'.format(sender_address, series_number)
-            session_name = members[member_name]
+            send_directive('LOG', done_indexes, sender, binary)
+
+        elif command in ('SYNC', 'SUBSCRIBE'):
+            # SUBSCRIBE is a versioned SYNC that also asks for changes to
+            # be pushed until it times out; clients repeat it as keepalive
+            ledger_epoch, ledger_version, force_sync, chest_version = (
+                arguments)
+            if ledger_version is not None:
+                member.ledger_epoch = ledger_epoch
+                member.ledger_version = ledger_version
+            if command == 'SUBSCRIBE':
+                member.subscribed_until = time.time() + SUBSCRIPTION_TIMEOUT
+                send_directive('SUBSCRIBED',
+                               [SUBSCRIPTION_TIMEOUT, member.push_sequence],
+                               sender, binary)
             if item_ledger[session_name] is None:
-                reply = 'REPORT {}'
-                client_send(reply, sender)
+                send_directive('REPORT', {}, sender, binary)
+            elif ledger_version is not None:
+                base, version, delta = get_ledger_delta(
+                    session_name, ledger_epoch, ledger_version)
+                if version != ledger_version or base == 0:
+                    send_directive('DELTA', [ledger_epochs[session_name],
+                                             base, version, delta],
+                                   sender, binary)
+                session_changes[session_name].discard(member_name)
             else:
                 if member_name in session_changes[session_name] or force_sync:
-                    my_ledger = item_ledger[session_name]
-                    session_inventory = {}
-                    for key in my_ledger:
-                        if my_ledger[key] > 0:
-                            session_inventory[key] = my_ledger[key]
-                    reply = 'SYNC {0}'.format(json.dumps(session_inventory))
-                    client_send(reply, sender)
+                    send_directive('SYNC',
+                                   get_session_inventory(session_name),
+                                   sender)
                     if member_name in session_changes[session_name]:
                         session_changes[session_name].remove(member_name)
+            if chest_version is not None:
+                # binary clients say which chest version they have and
+                # get the chest bytes that changed since then
+                member.chest_version = chest_version
+                if chest_version != chest_versions[session_name]:
+                    send_directive('CHEST_DELTA',
+                                   get_chest_delta(session_name,
+                                                   chest_version),
+                                   sender, binary)
+
+        elif command == 'CHESTS':
+            recipients = session_members[session_name] - {member_name}
+            chests = arguments
+            if not binary:
+                assert len(chests) == 0x40
+                chests = dict(enumerate(chests))
+            if merge_chests(session_name, chests):
+                journal('CHESTS', session_name,
+                        list(session_chests[session_name]))
+                for m in recipients:
+                    if members[m].subscribed and members[m].binary:
+                        push(members[m], 'CHESTS', 'CHEST_DELTA',
+                             get_chest_delta(session_name,
+                                             members[m].chest_version))
+                    elif members[m].subscribed:
+                        push(members[m], 'CHESTS', 'CHESTS',
+                             list(session_chests[session_name]))
+                        session_chest_changes[session_name].discard(m)
+                    elif not members[m].binary:
+                        session_chest_changes[session_name].add(m)
+            if binary:
+                # the reply tells the sender its bits have been merged
+                send_directive('CHEST_DELTA',
+                               get_chest_delta(session_name,
+                                               member.chest_version),
+                               sender, binary)
 
-        elif msg.startswith('CHESTS '):
-            _, series_number, payload = msg.split(' ', 2)
-            member_name = '{0}-{1}'.format(sender_address, series_number)
-            session_name = members[member_name]
-            session_members = {m for m in members
-                               if members[m] == session_name
-                               and m != member_name}
-            chests = json.loads(payload)
-            old_chests = session_chests[session_name]
-            assert len(old_chests) == len(chests) == 0x40
-            session_chests[session_name] = [a | b for (a, b) in
-                                            zip(old_chests, chests)]
-            session_chest_changes[session_name] |= session_members
+        elif command == 'ACK':
+            sequence, ledger_epoch, ledger_version, chest_version = arguments
+            member.outbox.pop(sequence, None)
+            member.ledger_epoch = ledger_epoch
+            member.ledger_version = ledger_version
+            if chest_version is not None:
+                member.chest_version = chest_version
 
         # status change book keeping
-        if (member_name is not None and member_name in session_status_changes
-                and session_status_changes[member_name]):
-            for command, character, change in list(
-                    sorted(session_status_changes[member_name])):
-                parameters = [character, change]
-                reply = '{0} {1}'.format(command, json.dumps(parameters))
-                client_send(reply, sender)
-                session_status_changes[member_name].remove(
-                    (command, character, change))
+        if member_name is not None and member_name in session_status_changes:
+            status_changes = session_status_changes.pop(member_name)
+            now = time.time()
+            status_changes = {
+                character: masks
+                for (character, masks) in status_changes.items()
+                if now - masks[2] <= STATUS_TIMEOUT}
+            for (directive, parameters) in get_status_directives(
+                    status_changes, binary):
+                send_directive(directive, parameters, sender, binary)
 
         # chest change book keeping
         if (member_name is not None and session_name is not None
                 and session_name in session_chest_changes
                 and member_name in session_chest_changes[session_name]):
-            reply = 'CHESTS {0}'.format(
-                json.dumps(session_chests[session_name]))
-            client_send(reply, sender)
+            send_directive('CHESTS', list(session_chests[session_name]),
+                           sender, binary)
             session_chest_changes[session_name].remove(member_name)
 
-    except socket.timeout:
-        for (key, oldtime) in list(processed_logs.items()):
-            if timestamp - oldtime > LOG_RETENTION_DURATION:
-                del(processed_logs[key])
-
     except:
-        error_msg = 'ERROR: {0} {1}'.format(exc_info()[0], exc_info()[1])
-        print(error_msg)
-        client_send(error_msg, sender)
+        send_error('{0} {1}'.format(exc_info()[0], exc_info()[1]), sender,
+                   binary)
 
-if __name__ == '__main__':
-    previous_network_time = 0
-    previous_backup_time = time()
 
+def write_file(filename, data, mode='w'):
+    f = open(filename, mode)
+    f.write(data)
+    f.flush()
+    fsync(f.fileno())
+    f.close()
+
+
+def flush_journal():
+    if not journal_buffer:
+        return None
+    data = ''.join(line + '\n' for line in journal_buffer)
+    journal_buffer.clear()
+    return journal_executor.submit(write_file, journal_filename, data, 'a')
+
+
+def get_state_files(prefix, suffix):
+    # returns (sequence, filename) pairs, oldest first
+    state_files = []
+    for fn in listdir('.'):
+        if fn.startswith(prefix) and fn.endswith(suffix):
+            sequence = fn[len(prefix):-len(suffix)]
+            if sequence.isdigit():
+                state_files.append((int(sequence), fn))
+    return sorted(state_files)
+
+
+def snapshot_state():
+    state_members = {m: [members[m].session_name, members[m].log_watermark,
+                         sorted(members[m].log_window)] for m in members}
+    ledgers = {}
+    for (session_name, my_ledger) in item_ledger.items():
+        if my_ledger is None:
+            ledgers[session_name] = None
+            continue
+        ledgers[session_name] = [ledger_epochs[session_name],
+                                 ledger_versions[session_name],
+                                 my_ledger.tolist(),
+                                 item_versions[session_name].tolist()]
+    chests = {key: list(value) for (key, value) in session_chests.items()}
+    for (session_name, (ledger, my_chests, dormant_state_members)) in (
+            dormant_sessions.items()):
+        ledgers[session_name] = ledger
+        chests[session_name] = my_chests
+        state_members.update(dormant_state_members)
+    return {'sequence': journal_sequence, 'members': state_members,
+            'ledgers': ledgers, 'chests': chests}
+
+
+def write_snapshot_file(state):
+    filename = SNAPSHOT_FORMAT.format(state_prefix, state['sequence'])
+    write_file(filename + '.tmp', json.dumps(state))
+    replace(filename + '.tmp', filename)
+
+    snapshots = get_state_files(state_prefix + 'snapshot_', '.json')
+    if len(snapshots) <= BACKUP_RETENTION:
+        return
+    oldest_sequence = snapshots[-BACKUP_RETENTION][0]
+    for (sequence, fn) in snapshots[:-BACKUP_RETENTION]:
+        remove(fn)
+    for (sequence, fn) in get_state_files(state_prefix + 'journal_',
+                                          '.jsonl'):
+        if sequence < oldest_sequence:
+            remove(fn)
+
+
+def write_snapshot():
+    # The snapshot is taken here, between datagrams, so it is consistent;
+    # serializing and writing it happen on the journal thread, after any
+    # journal entries that were buffered before it.
+    global journal_filename, snapshot_sequence
+    if journal_sequence == snapshot_sequence:
+        return
+    flush_journal()
+    state = snapshot_state()
+    snapshot_sequence = journal_sequence
+    journal_filename = JOURNAL_FORMAT.format(state_prefix, journal_sequence)
+    journal_executor.submit(write_snapshot_file, state)
+
+
+def load_snapshot(filename):
+    f = open(filename)
+    state = json.loads(f.read())
+    f.close()
+
+    for (session_name, ledger) in state['ledgers'].items():
+        dormant_sessions[session_name] = (
+            ledger, state['chests'][session_name], {})
+    for (m, member_state) in state['members'].items():
+        session_name = member_state[0]
+        dormant_sessions[session_name][2][m] = member_state
+        dormant_members[m] = session_name
+
+    return state['sequence']
+
+
+def replay_journal(filename, sequence):
+    clean = False
+    f = open(filename)
+    for line in f:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # a torn final line from a crash mid-write
+            break
+        if record[0] <= sequence:
+            continue
+        try:
+            apply_journal_record(*record[1:])
+        except KeyError:
+            # a member or session the saved state does not know about
+            print('Skipped journal entry {0}: {1}'.format(
+                record[0], line.strip()))
+        sequence = record[0]
+        clean = record[1] == 'SHUTDOWN'
+    f.close()
+    return sequence, clean
+
+
+def restore_state(legacy_backups=True):
+    global journal_filename, journal_sequence, snapshot_sequence
+    journal_filename = JOURNAL_FORMAT.format(state_prefix, 0)
+    snapshots = get_state_files(state_prefix + 'snapshot_', '.json')
+    journals = get_state_files(state_prefix + 'journal_', '.jsonl')
+    if not (snapshots or journals):
+        if legacy_backups and load_backup():
+            # the journal only holds what changes from here on, so the
+            # backup becomes the first snapshot before any request is served
+            write_snapshot_file(snapshot_state())
+        return
+
+    sequence, clean = 0, False
+    if snapshots:
+        sequence = load_snapshot(snapshots[-1][1])
+    snapshot_sequence = sequence
+    for (journal_number, fn) in journals:
+        if journal_number >= snapshot_sequence:
+            sequence, clean = replay_journal(fn, sequence)
+
+    journal_sequence = sequence
+    journal_filename = JOURNAL_FORMAT.format(state_prefix, sequence)
+    print('Restored {0} sessions up to journal entry {1} ({2}).'.format(
+        len(item_ledger) + len(dormant_sessions), sequence,
+        'clean shutdown' if clean else 'unclean shutdown'))
+    if clean:
+        # nothing was lost, so clients can keep their ledger versions and
+        # a versioned SYNC from an up-to-date client needs no reply
+        return
+
+    # the journal is flushed in batches, so clients may have seen changes
+    # that were lost; fresh epochs make them resync in full
+    for m in members:
+        session_changes[members[m].session_name].add(m)
+    for session_name in item_ledger:
+        if item_ledger[session_name] is not None:
+            ledger_epochs[session_name] = new_ledger_epoch()
+    for (session_name, (ledger, _, _)) in dormant_sessions.items():
+        if ledger is not None:
+            ledger[0] = new_ledger_epoch()
+        resync_sessions.add(session_name)
+
+
+def load_backup():
+    global item_ledger
     backups = [fn for fn in listdir('.') if fn.startswith('parity_backup_')
                and fn.endswith('.json')]
-    if backups:
-        chosen_backup = sorted(backups)[-1]
-        f = open(chosen_backup)
-        chosen_backup = json.loads(f.read())
-        f.close()
-        members, item_ledger, processed_logs, session_chests = chosen_backup
-        for m in members:
-            session_name = members[m]
-            session_changes[session_name].add(m)
-
-        for key in item_ledger:
-            il = item_ledger[key]
-            item_ledger[key] = convert_dict_keys_to_int(il)
-
-    while True:
-        now = time()
-        diff = now - previous_network_time
-        if diff < POLL_INTERVAL:
-            sleep(POLL_INTERVAL - diff)
-            previous_network_time = time()
+    if not backups:
+        return False
+
+    chosen_backup = sorted(backups)[-1]
+    f = open(chosen_backup)
+    chosen_backup = json.loads(f.read())
+    f.close()
+    member_sessions, item_ledger, log_marks, chests = chosen_backup[:4]
+    for (key, value) in chests.items():
+        initialize_chests(key, value)
+    if len(chosen_backup) > 4:
+        ledger_versions.update(chosen_backup[4])
+        for key, iv in chosen_backup[5].items():
+            item_versions[key] = load_ledger_array(iv, 'I')
+    members.clear()
+    session_members.clear()
+    for m, session_name in member_sessions.items():
+        add_member(m, session_name)
+        session_changes[session_name].add(m)
+
+    for (key, value) in log_marks.items():
+        if isinstance(value, list):
+            member = members[key]
+            member.log_watermark, log_window = value
+            member.log_window = set(log_window)
         else:
-            previous_network_time = now
+            # older backups stored one '<member>-<index>' key per entry
+            m, index = key.rsplit('-', 1)
+            if m in members:
+                members[m].mark_log(int(index))
+
+    for key in item_ledger:
+        il = item_ledger[key]
+        if il is None:
+            continue
+        item_ledger[key] = load_ledger_array(il, 'i')
+        # a backup may predate the last changes clients saw, so restored
+        # ledgers get a fresh epoch and clients resync them in full
+        ledger_epochs[key] = new_ledger_epoch()
+        if key not in ledger_versions:
+            ledger_versions[key] = 0
+            item_versions[key] = array('I', [0]) * 0x100
+            bump_ledger_version(key, range(0x100))
+    return True
+
+
+def schedule_periodic(loop, interval, callback):
+    def run():
+        try:
+            callback()
+        except:
+            error_msg = 'ERROR: {0} {1}'.format(exc_info()[0], exc_info()[1])
+            print(error_msg)
+        loop.call_later(interval, run)
+
+    return loop.call_later(interval, run)
+
+
+class ParityServerProtocol(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        global server_transport
+        server_transport = transport
+
+    def datagram_received(self, data, sender):
+        begin_replies()
+        try:
+            handle_datagram(data, sender)
+        except:
+            error_msg = 'ERROR: {0} {1}'.format(exc_info()[0], exc_info()[1])
+            print(error_msg)
+        finally:
+            flush_replies()
 
-        if int(round(now - previous_backup_time)) >= BACKUP_INTERVAL:
-            previous_backup_time = now
-            backup = json.dumps([members, item_ledger, processed_logs,
-                                 session_chests])
-            timestamp = datetime.now().strftime('%Y%m%d-%H%M')
+    def error_received(self, exc):
+        print('ERROR: {0} {1}'.format(type(exc), exc))
 
-            f = open('parity_backup_{0}.json'.format(timestamp), 'w+')
-            f.write(backup)
-            f.close()
 
+class ShardRouterProtocol(ParityServerProtocol):
+    def __init__(self, connections):
+        self.connections = connections
+
+    def datagram_received(self, data, sender):
         try:
-            main_loop()
+            if data[0] == PACKET_MAGIC:
+                _, _, series_number, _ = PACKET_HEADER.unpack_from(data)
+                member_name = '{0}-{1}'.format(sender[0], series_number)
+                if member_name in pending_routes:
+                    pending_routes[member_name].append(
+                        ('PACKET', data, sender))
+                    return
+                shard = member_shards.get(member_name, 0)
+                self.connections[shard].send(('PACKET', data, sender))
+                return
+            msg = client_receive(data)
+            message = ('DATAGRAM', msg, sender, len(data))
+            if msg == 'STATS':
+                # every shard answers with its own metrics
+                for connection in self.connections:
+                    connection.send(message)
+                return
+            shard = route_message(msg, sender, self.connections, message)
+            if shard is not None:
+                self.connections[shard].send(message)
         except:
             error_msg = 'ERROR: {0} {1}'.format(exc_info()[0], exc_info()[1])
             print(error_msg)
+            client_send(error_msg, sender)
+
+
+def get_shard(session_name, shard_count):
+    return zlib.crc32(session_name.encode()) % shard_count
+
+
+def route_message(msg, sender, connections, message):
+    # Sessions are owned by one shard each. NEW and JOIN name the session,
+    # everything after that is routed by member. Until the shard answers
+    # a NEW or JOIN, the member's other requests are held back, and the
+    # member only moves once the new shard says that it joined.
+    command, _, parameters = msg.partition(' ')
+    if command in ('NEW', 'JOIN'):
+        session_name, _, parameters = parameters.partition(' ')
+    series_number = parameters.split(' ', 1)[0]
+    member_name = '{0}-{1}'.format(sender[0], series_number)
+    if command in ('NEW', 'JOIN'):
+        if series_number:
+            pending_routes.setdefault(member_name, [])
+        return get_shard(session_name, len(connections))
+
+    if member_name in pending_routes:
+        pending_routes[member_name].append(message)
+        return None
+    return member_shards.get(member_name, 0)
+
+
+def receive_announcement(shard_index, connections, loop):
+    connection = connections[shard_index]
+    try:
+        outcome, member_name = connection.recv()
+    except EOFError:
+        loop.remove_reader(connection.fileno())
+        return
+    if outcome == 'JOINED':
+        previous_shard = member_shards.get(member_name)
+        if previous_shard is not None and previous_shard != shard_index:
+            connections[previous_shard].send(('LEAVE', member_name))
+        member_shards[member_name] = shard_index
+    shard = member_shards.get(member_name, 0)
+    for message in pending_routes.pop(member_name, []):
+        connections[shard].send(message)
+
+
+def schedule_maintenance(loop):
+    schedule_periodic(loop, JOURNAL_FLUSH_INTERVAL, flush_journal)
+    schedule_periodic(loop, BACKUP_INTERVAL, write_snapshot)
+    schedule_periodic(loop, RETRANSMIT_INTERVAL, retransmit_pushes)
+    schedule_periodic(loop, STATUS_TIMEOUT, expire_status_changes)
+    if METRICS_INTERVAL:
+        schedule_periodic(loop, METRICS_INTERVAL, print_metrics)
+
+
+def stop_on_signals(loop, stop):
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(
+                signum, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:
+            pass
+
+
+async def serve():
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        ParityServerProtocol, local_addr=(SERVER_IP, SERVER_PORT))
+    schedule_maintenance(loop)
+    stop = loop.create_future()
+    stop_on_signals(loop, stop)
+    try:
+        await stop
+        journal('SHUTDOWN')
+    finally:
+        transport.close()
+        flush_journal()
+        journal_executor.shutdown(wait=True)
+
+
+async def serve_shard(connection):
+    loop = asyncio.get_running_loop()
+    schedule_maintenance(loop)
+    stop = loop.create_future()
+    stop_on_signals(loop, stop)
+
+    def receive():
+        while not stop.done() and connection.poll():
+            try:
+                message = connection.recv()
+            except EOFError:
+                message = None
+            if message is None:
+                stop.set_result(None)
+            elif message[0] == 'LEAVE':
+                leave_shard(message[1])
+                journal('LEAVE', message[1])
+            elif message[0] == 'PACKET':
+                _, data, sender = message
+                begin_replies()
+                try:
+                    handle_datagram(data, sender)
+                finally:
+                    flush_replies()
+            else:
+                _, msg, sender, wire_size = message
+                datagram_counts['received'] += 1
+                begin_replies()
+                try:
+                    handle_message(msg, sender, wire_size)
+                finally:
+                    flush_replies()
+
+    loop.add_reader(connection.fileno(), receive)
+    try:
+        await stop
+        journal('SHUTDOWN')
+    finally:
+        loop.remove_reader(connection.fileno())
+        flush_journal()
+        journal_executor.shutdown(wait=True)
+
+
+def run_shard(shard_index, connection, sock, router_connections):
+    # Replies go straight out of the shared socket; only the router reads
+    # from it. The router's ends of the pipes were inherited too; they are
+    # closed so that the pipe reaches EOF if the router dies.
+    global server_transport, state_prefix, router_connection
+    for inherited_connection in router_connections:
+        inherited_connection.close()
+    server_transport = sock
+    state_prefix = 'parity_shard{0}_'.format(shard_index)
+    restore_state(legacy_backups=False)
+    connection.send(list(members) + list(dormant_members))
+    router_connection = connection
+    asyncio.run(serve_shard(connection))
+
+
+def start_shards(shard_count):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((SERVER_IP, SERVER_PORT))
+    connections, processes = [], []
+    for shard_index in range(shard_count):
+        connection, shard_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=run_shard, daemon=True,
+            args=(shard_index, shard_connection, sock,
+                  connections + [connection]))
+        process.start()
+        shard_connection.close()
+        connections.append(connection)
+        processes.append(process)
+
+    for (shard_index, connection) in enumerate(connections):
+        for member_name in connection.recv():
+            member_shards[member_name] = shard_index
+    return sock, connections, processes
+
+
+async def serve_router(sock, connections):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: ShardRouterProtocol(connections), sock=sock)
+    for (shard_index, connection) in enumerate(connections):
+        loop.add_reader(connection.fileno(), receive_announcement,
+                        shard_index, connections, loop)
+    stop = loop.create_future()
+    stop_on_signals(loop, stop)
+    try:
+        await stop
+    finally:
+        transport.close()
+        for connection in connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', default=SERVER_IP)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='worker processes, each owning some sessions')
+    args = parser.parse_args()
+    SERVER_IP, SERVER_PORT = args.address, args.port
+
+    if args.shards > 1:
+        # shards are started before any event loop exists in this process
+        sock, connections, processes = start_shards(args.shards)
+        asyncio.run(serve_router(sock, connections))
+        for process in processes:
+            process.join()
+    else:
+        restore_state()
+        asyncio.run(serve())